@@ -1,29 +1,28 @@
 import streamlit as st
-from docxtpl import DocxTemplate, InlineImage
-from docx.shared import Mm
-import fitz  # PyMuPDF
-import io
 import os
 import shutil
-import subprocess
 import tempfile
 import pandas as pd
-import matplotlib.pyplot as plt
 from streamlit_paste_button import paste_image_button
-from PIL import Image
-import platform
 import time
-import calendar
 import json
-from pathlib import Path
-import zipfile
+import armazem_evidencias
+import armazenamento
+import cache_render
+import cache_template
+import catalogo
+import conversor_pdf
+import diagnostico
+import fila_relatorios
+import graficos
+import miniaturas
+import motor_relatorio
+import restauro_backup
+from motor_relatorio import DIMENSOES_CAMPOS, FORM_KEYS, MESES_PT
 
 # --- CONFIGURAÇÕES DE LAYOUT ---
 st.set_page_config(page_title="RELATÓRIO ASSISTENCIAL MENSAL - NOVA CIDADE", layout="wide")
 
-# --- CONSTANTES DO CONTRATO ---
-META_DIARIA_CONTRATO = 250
-
 # --- CUSTOM CSS ---
 st.markdown("""
     <style>
@@ -65,26 +64,14 @@ st.markdown("""
     </style>
     """, unsafe_allow_html=True)
 
-# --- DICIONÁRIO DE DIMENSÕES ---
-DIMENSOES_CAMPOS = {
-    "IMAGEM_PRINT_ATENDIMENTO": 165, "PRINT_CLASSIFICACAO": 160,
-    "IMAGEM_DOCUMENTO_RAIO_X": 150, "TABELA_TRANSFERENCIA": 90,
-    "GRAFICO_TRANSFERENCIA": 150, "TABELA_OBITO": 180, 
-    "TABELA_CCIH": 175, "IMAGEM_NEP": 160,
-    "IMAGEM_TREINAMENTO_INTERNO": 160, "IMAGEM_MELHORIAS": 160,
-    "GRAFICO_OUVIDORIA": 155, "PDF_OUVIDORIA_INTERNA": 165,
-    "TABELA_QUALITATIVA_IMG": 190
-}
-
 # --- CONFIGURAÇÃO DE PERSISTÊNCIA ---
-BASE_RELATORIOS_DIR = Path("relatorios_salvos_novacidade")
+BASE_RELATORIOS_DIR = armazenamento.BASE_RELATORIOS_DIR
 BASE_RELATORIOS_DIR.mkdir(exist_ok=True)
-
-FORM_KEYS = [
-    "sel_mes", "sel_ano", "in_total", "in_rx", "in_mc", "in_mp",
-    "in_oc", "in_op", "in_ccih", "in_oi", "in_oe", "in_taxa",
-    "in_tt", "in_to", "in_to_menor", "in_to_maior"
-]
+# As evidências da sessão ficam em disco; o estado guarda só handles (nome, tipo, hash)
+ARMAZEM = armazem_evidencias.ARMAZEM
+# ZIPs de backup preparados para download; os de sessões que já terminaram são apagados por idade
+BACKUPS_DIR = os.environ.get("BACKUPS_DIR", os.path.join(tempfile.gettempdir(), "backups_novacidade"))
+RETENCAO_BACKUPS_SEGUNDOS = int(os.environ.get("BACKUPS_RETENCAO_HORAS", 6)) * 3600
 
 # --- ESTADO DA SESSÃO ---
 if 'dados_sessao' not in st.session_state:
@@ -93,184 +80,129 @@ if 'dados_sessao' not in st.session_state:
 if 'relatorio_atual' not in st.session_state:
     st.session_state.relatorio_atual = ""
 
+if 'upload_gen' not in st.session_state:
+    st.session_state.upload_gen = {}
+
+# Arranca (uma vez por processo) o serviço de conversão, para os perfis do
+# LibreOffice já estarem criados quando o primeiro relatório for gerado
+conversor_pdf.obter_servico()
+
 # --- FUNÇÕES DE PERSISTÊNCIA ---
 
 def _normalizar_nome(nome):
     return "".join([c if c.isalnum() else "_" for c in nome])
 
 def listar_relatorios_salvos():
-    return sorted([p.name for p in BASE_RELATORIOS_DIR.iterdir() if p.is_dir()])
+    """Relatórios do catálogo (mais recentes primeiro), sem percorrer as pastas."""
+    return catalogo.obter_catalogo().listar()
 
 def salvar_relatorio(nome):
     if not nome: return
     nome_norm = _normalizar_nome(nome)
     pasta = BASE_RELATORIOS_DIR / nome_norm
-    pasta.mkdir(parents=True, exist_ok=True)
-    pasta_evid = pasta / "evidencias"
-    pasta_evid.mkdir(exist_ok=True)
+    armazem = armazenamento.ArmazemBlobs(BASE_RELATORIOS_DIR)
 
     evid_meta = {}
     for m, itens in st.session_state.dados_sessao.items():
         evid_meta[m] = []
-        for i, item in enumerate(itens):
-            ext = ".png"
-            fname = f"{m}_{i}{ext}"
-            caminho_dest = pasta_evid / fname
-            
-            conteudo = item["content"]
-            if isinstance(conteudo, Image.Image):
-                conteudo.save(caminho_dest, format="PNG")
-            else:
-                if hasattr(conteudo, "getvalue"): data = conteudo.getvalue()
-                elif hasattr(conteudo, "read"): 
-                    conteudo.seek(0)
-                    data = conteudo.read()
-                else: data = conteudo
-                with open(caminho_dest, "wb") as f: f.write(data)
-                
-            evid_meta[m].append({"name": item["name"], "file": f"evidencias/{fname}", "type": item["type"]})
-
-    estado = {"form_state": {k: st.session_state.get(k) for k in FORM_KEYS}, "evidencias": evid_meta}
-    with open(pasta / "estado.json", "w", encoding="utf-8") as f:
-        json.dump(estado, f, ensure_ascii=False, indent=2)
+        for item in itens:
+            # Só grava (e só codifica) o que ainda não está no armazém
+            sha = item["sha256"]
+            if item.get("blob") != sha or not armazem.existe(sha):
+                armazem.gravar(ARMAZEM.ler(sha), sha)
+                item["blob"] = sha
+            evid_meta[m].append({"name": item["name"], "type": item["type"], "sha256": sha,
+                                 "size": armazem.caminho(sha).stat().st_size})
+
+    form_state = {k: st.session_state.get(k) for k in FORM_KEYS}
+    armazenamento.salvar_manifesto(pasta, form_state, evid_meta)
+    catalogo.obter_catalogo().registar(nome_norm, form_state, evid_meta)
     st.session_state.relatorio_atual = nome_norm
     st.success(f"Relatório '{nome}' salvo com sucesso!")
 
 def carregar_relatorio(nome_pasta):
     pasta = BASE_RELATORIOS_DIR / nome_pasta
-    estado_path = pasta / "estado.json"
-    if not estado_path.exists(): return
+    if not (pasta / "estado.json").exists(): return
     
-    with open(estado_path, "r", encoding="utf-8") as f:
-        estado = json.load(f)
-    
-    for k, v in estado.get("form_state", {}).items():
+    # Só o estado e os metadados: as evidências são lidas do armazém quando forem precisas
+    form_state, evidencias = motor_relatorio.abrir_relatorio_pasta(pasta)
+    evidencias, repetidos = armazem_evidencias.deduplicar(evidencias)
+    for k, v in form_state.items():
         st.session_state[k] = v
-        
-    st.session_state.dados_sessao = {m: [] for m in DIMENSOES_CAMPOS.keys()}
-    for m, lista in estado.get("evidencias", {}).items():
-        for meta in lista:
-            p = pasta / meta["file"]
-            if p.exists():
-                with open(p, "rb") as f:
-                    bio = io.BytesIO(f.read())
-                    bio.name = meta["name"]
-                    st.session_state.dados_sessao[m].append({"name": meta["name"], "content": bio, "type": meta["type"]})
+    st.session_state.dados_sessao = evidencias
     st.session_state.relatorio_atual = nome_pasta
     st.success(f"Relatório carregado!")
+    if repetidos:
+        st.info(f"{len(repetidos)} evidência(s) repetida(s) foram ignoradas.")
+
+def anexar_evidencia(m, data, nome, tipo):
+    """Guarda ``data`` no armazém e anexa-a a ``m``, salvo se o mesmo conteúdo já estiver na sessão."""
+    handle = ARMAZEM.adicionar(data, nome, tipo)
+    existente = armazem_evidencias.localizar(st.session_state.dados_sessao, handle["sha256"])
+    if existente is not None:
+        marcador, item = existente
+        onde = "neste campo" if marcador == m else f"em {marcador}"
+        st.toast(f"⚠️ Conteúdo já anexado {onde} ({item['name']}).")
+        return False
+    st.session_state.dados_sessao[m].append(handle)
+    return True
+
+def anexar_grafico(m):
+    """Desenha o gráfico de ``m`` (histórico do catálogo + mês atual) e troca o anterior gerado."""
+    dados = graficos.historico(catalogo.obter_catalogo().listar(), {k: st.session_state.get(k) for k in FORM_KEYS})
+    png = graficos.gerar_grafico(m, dados)
+    if png is None:
+        st.toast("⚠️ Preencha os dados do mês (ou salve relatórios anteriores) para gerar o gráfico.")
+        return
+    nome = graficos.NOMES[m]
+    st.session_state.dados_sessao[m] = [x for x in st.session_state.dados_sessao[m] if x["name"] != nome]
+    if anexar_evidencia(m, png, nome, "p"):
+        st.toast(f"Gráfico gerado com {len(dados)} mês(es) de histórico.")
 
 # --- FUNÇÕES DE EXPORTAR E IMPORTAR (NUVEM / ZIP) ---
+def _assinatura_backup():
+    """Identifica o conteúdo atual da sessão sem ler nem codificar as evidências."""
+    partes = [json.dumps({k: st.session_state.get(k) for k in FORM_KEYS}, sort_keys=True, default=str)]
+    for marcador, itens in st.session_state.dados_sessao.items():
+        partes.extend(f"{marcador}|{item['name']}|{item['type']}|{item['sha256']}" for item in itens)
+    return cache_render.hash_bytes("\n".join(partes).encode("utf-8"))
+
+def _ler_ficheiro(caminho):
+    """Para os ``download_button`` com ``data`` diferido: só lê o ficheiro quando é clicado."""
+    with open(caminho, "rb") as f:
+        return f.read()
+
+def _podar_backups():
+    limite = time.time() - RETENCAO_BACKUPS_SEGUNDOS
+    for entrada in os.scandir(BACKUPS_DIR):
+        try:
+            if entrada.is_file() and entrada.stat().st_mtime < limite:
+                os.remove(entrada.path)
+        except OSError:
+            pass  # apagado por outra sessão
+
 def gerar_backup_zip():
-    """Cria um ficheiro ZIP em memória contendo o estado.json e as imagens."""
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-        evid_meta = {}
-        for marcador, itens in st.session_state.dados_sessao.items():
-            evid_meta[marcador] = []
-            for i, item in enumerate(itens):
-                # Extrair os bytes da imagem/ficheiro
-                conteudo = item["content"]
-                file_bytes = b""
-                if isinstance(conteudo, Image.Image):
-                    img_buf = io.BytesIO()
-                    conteudo.save(img_buf, format="PNG")
-                    file_bytes = img_buf.getvalue()
-                else:
-                    if hasattr(conteudo, "getvalue"): file_bytes = conteudo.getvalue()
-                    elif hasattr(conteudo, "read"): 
-                        conteudo.seek(0)
-                        file_bytes = conteudo.read()
-                    else: file_bytes = conteudo
-                
-                # Guardar ficheiro dentro do ZIP
-                nome_interno = f"evidencias/{marcador}_{i}.png"
-                zf.writestr(nome_interno, file_bytes)
-                
-                # Registar metadados
-                evid_meta[marcador].append({"name": item["name"], "file": nome_interno, "type": item["type"]})
-        
-        # Guardar o estado do formulário no ZIP
-        estado = {"form_state": {k: st.session_state.get(k) for k in FORM_KEYS}, "evidencias": evid_meta}
-        zf.writestr("estado.json", json.dumps(estado, ensure_ascii=False, indent=2))
-    
-    buf.seek(0)
-    return buf
+    """Grava em ``BACKUPS_DIR`` um ZIP com o estado.json e as evidências e devolve o caminho."""
+    os.makedirs(BACKUPS_DIR, exist_ok=True)
+    _podar_backups()
+    fd, caminho = tempfile.mkstemp(prefix="backup_", suffix=".zip", dir=BACKUPS_DIR)
+    with os.fdopen(fd, "wb") as f:
+        motor_relatorio.escrever_backup_zip({k: st.session_state.get(k) for k in FORM_KEYS}, st.session_state.dados_sessao, f)
+    return caminho
 
 def processar_upload_backup(uploaded_zip):
     """Lê um ficheiro ZIP e restaura todos os dados para a interface."""
     try:
-        with zipfile.ZipFile(uploaded_zip, "r") as zf:
-            # 1. Recuperar os textos e números
-            estado_str = zf.read("estado.json").decode("utf-8")
-            estado = json.loads(estado_str)
-            
-            for k, v in estado.get("form_state", {}).items():
-                st.session_state[k] = v
-            
-            # 2. Recuperar as imagens/evidências
-            st.session_state.dados_sessao = {m: [] for m in DIMENSOES_CAMPOS.keys()}
-            for marcador, lista in estado.get("evidencias", {}).items():
-                for meta in lista:
-                    try:
-                        file_bytes = zf.read(meta["file"])
-                        bio = io.BytesIO(file_bytes)
-                        bio.name = meta["name"]
-                        st.session_state.dados_sessao[marcador].append({
-                            "name": meta["name"], 
-                            "content": bio, 
-                            "type": meta["type"]
-                        })
-                    except Exception as e:
-                        pass # Ignora ficheiros corrompidos no ZIP
+        form_state, evidencias, falhas = restauro_backup.restaurar(uploaded_zip)
+        for k, v in form_state.items():
+            st.session_state[k] = v
+        st.session_state.dados_sessao = evidencias
+        # Mostradas junto ao upload até ao próximo restauro
+        st.session_state.falhas_restauro = falhas
         st.success("✅ Backup importado com sucesso! Pode continuar o seu trabalho.")
     except Exception as e:
         st.error(f"Erro ao ler o ficheiro de backup: {e}")
 
-# --- FUNÇÕES CORE ---
-def converter_para_pdf(docx_path, output_dir):
-    comando = 'libreoffice'
-    if platform.system() == "Windows":
-        caminhos = ['libreoffice', r'C:\Program Files\LibreOffice\program\soffice.exe', r'C:\Program Files (x86)\LibreOffice\program\soffice.exe']
-        for p in caminhos:
-            try:
-                subprocess.run([p, '--version'], capture_output=True, check=True)
-                comando = p
-                break
-            except: continue
-    subprocess.run([comando, '--headless', '--convert-to', 'pdf', '--outdir', output_dir, docx_path], check=True)
-
-def processar_item_lista(doc_template, item, marcador):
-    largura = DIMENSOES_CAMPOS.get(marcador, 165)
-    try:
-        if isinstance(item, Image.Image):
-            img_buf = io.BytesIO()
-            item.save(img_buf, format='PNG')
-            img_buf.seek(0)
-            return [InlineImage(doc_template, img_buf, width=Mm(largura))]
-        
-        if isinstance(item, bytes):
-            return [InlineImage(doc_template, io.BytesIO(item), width=Mm(largura))]
-            
-        if hasattr(item, 'seek'): item.seek(0)
-        
-        ext = getattr(item, 'name', '').lower()
-        if marcador == "TABELA_TRANSFERENCIA" and (ext.endswith(".xlsx") or ext.endswith(".xls")):
-            res = excel_para_imagem(doc_template, item)
-            return [res] if res else []
-            
-        if ext.endswith(".pdf"):
-            pdf = fitz.open(stream=item.read(), filetype="pdf")
-            imgs = []
-            for pg in pdf:
-                pix = pg.get_pixmap(matrix=fitz.Matrix(2, 2))
-                imgs.append(InlineImage(doc_template, io.BytesIO(pix.tobytes()), width=Mm(largura)))
-            pdf.close()
-            return imgs
-            
-        return [InlineImage(doc_template, item, width=Mm(largura))]
-    except Exception as e:
-        return []
-
 # --- SIDEBAR ---
 with st.sidebar:
     st.image("https://cdn-icons-png.flaticon.com/512/3208/3208726.png", width=100)
@@ -281,11 +213,42 @@ with st.sidebar:
     if st.button("🗑 Limpar Todos os Dados"):
         st.session_state.dados_sessao = {m: [] for m in DIMENSOES_CAMPOS.keys()}
         st.rerun()
+    with st.expander("Caches do servidor", expanded=False):
+        stats_tpl = cache_template.CACHE.estatisticas()
+        st.caption(f"Template: {stats_tpl['template_hits']} hits / {stats_tpl['template_misses']} misses "
+                   f"({stats_tpl['template_recargas']} recargas)")
+        st.caption(f"Jinja compilado: {stats_tpl['jinja_hits']} hits / {stats_tpl['jinja_misses']} misses")
+        st.caption(f"Imagens renderizadas: {cache_render.CACHE.hits} hits / {cache_render.CACHE.misses} misses")
 
 # --- UI PRINCIPAL ---
 st.title("Automação de Relatórios - UPA Nova Cidade")
 
 # --- GERENCIAMENTO DE RELATÓRIOS ---
+with st.container(border=True):
+    st.markdown("#### 🗂️ Relatórios Salvos")
+    col_sel, col_salvar = st.columns(2)
+
+    with col_sel:
+        salvos = listar_relatorios_salvos()
+        if salvos:
+            rotulos = {
+                r["nome"]: f"{r['mes'].capitalize()}/{r['ano']} · {r['nome']} · {r['evidencias']} evidências · {r['bytes'] / 1024 / 1024:.1f} MB"
+                for r in salvos
+            }
+            escolhido = st.selectbox("Abrir relatório salvo", list(rotulos), format_func=rotulos.get, key="sel_relatorio_salvo")
+            if st.button("📂 Carregar Relatório", key="btn_carregar", use_container_width=True):
+                carregar_relatorio(escolhido)
+                time.sleep(0.5)
+                st.rerun()
+        else:
+            st.caption("Ainda não há relatórios salvos.")
+
+    with col_salvar:
+        nome_salvar = st.text_input("Salvar como", value=st.session_state.relatorio_atual or
+                                    f"{st.session_state.get('sel_mes', '')}_{st.session_state.get('sel_ano', '')}", key="nome_salvar")
+        if st.button("💾 Salvar Relatório", key="btn_salvar", use_container_width=True):
+            salvar_relatorio(nome_salvar)
+
 # --- BACKUP DE SEGURANÇA (DOWNLOAD/UPLOAD) ---
 with st.container(border=True):
     st.markdown("#### ☁️ Backup de Segurança (Exportar / Importar)")
@@ -302,21 +265,34 @@ with st.container(border=True):
                 processar_upload_backup(zip_upload)
                 time.sleep(1)
                 st.rerun()
+        if st.session_state.get("falhas_restauro"):
+            falhas = st.session_state.falhas_restauro
+            st.warning(f"{len(falhas)} evidência(s) do backup não foram restauradas:\n\n" + "\n".join(
+                f"- **{f['nome']}** ({f['marcador']}): {f['motivo']}" for f in falhas))
 
     with col_down:
         # Exportar (Gerar e fazer Download do .zip)
         st.markdown("<div style='height: 28px;'></div>", unsafe_allow_html=True) # Espaçamento
-        zip_buffer = gerar_backup_zip()
-        nome_backup = f"Backup_Relatorio_{st.session_state.get('sel_mes', 'Atual')}.zip"
-        
-        st.download_button(
-            label="📤 Guardar Progresso (Baixar .zip)",
-            data=zip_buffer,
-            file_name=nome_backup,
-            mime="application/zip",
-            type="primary",
-            use_container_width=True
-        )
+        # O ZIP só é montado quando pedido; enquanto nada mudar, o mesmo ficheiro é reaproveitado
+        assinatura = _assinatura_backup()
+        pronto = st.session_state.get("backup_pronto")
+        if pronto and pronto["assinatura"] == assinatura and os.path.exists(pronto["caminho"]):
+            nome_backup = f"Backup_Relatorio_{st.session_state.get('sel_mes', 'Atual')}.zip"
+            # Lido só quando o botão é clicado, para o ZIP não voltar à memória em cada rerun
+            st.download_button(
+                label="📤 Guardar Progresso (Baixar .zip)",
+                data=lambda p=pronto["caminho"]: _ler_ficheiro(p),
+                file_name=nome_backup,
+                mime="application/zip",
+                type="primary",
+                use_container_width=True
+            )
+        elif st.button("📦 Preparar Backup (.zip)", key="btn_backup", use_container_width=True):
+            caminho_zip = gerar_backup_zip()
+            if pronto and os.path.exists(pronto["caminho"]):
+                os.remove(pronto["caminho"])
+            st.session_state.backup_pronto = {"assinatura": assinatura, "caminho": caminho_zip}
+            st.rerun()
 
 st.caption("Versão 0.7.12")
 
@@ -325,25 +301,32 @@ t_manual, t_evidencia = st.tabs(["Dados", "Evidências"])
 with t_manual:
     st.markdown("### Configuração do Período e Metas")
     c1, c2, c3 = st.columns(3)
-    meses_pt = ["janeiro", "fevereiro", "março", "abril", "maio", "junho", "julho", "agosto", "setembro", "outubro", "novembro", "dezembro"]
     with c1: 
-        mes_selecionado = st.selectbox("Mês de Referência", meses_pt, key="sel_mes")
+        mes_selecionado = st.selectbox("Mês de Referência", MESES_PT, key="sel_mes")
     with c2: 
         ano_selecionado = st.selectbox("Ano", [2025, 2026, 2027, 2028], index=2, key="sel_ano")
     with c3:
         st.text_input("Total de Atendimentos", key="in_total")
 
-    mes_num = meses_pt.index(mes_selecionado) + 1
-    dias_no_mes = calendar.monthrange(ano_selecionado, mes_num)[1]
-    meta_calculada = dias_no_mes * META_DIARIA_CONTRATO
-    meta_min = int(meta_calculada * 0.75)
-    meta_max = int(meta_calculada * 1.25)
+    meta_calculada, meta_min, meta_max = motor_relatorio.calcular_metas(mes_selecionado, ano_selecionado)
 
     c4, c5, c6 = st.columns(3)
     with c4: st.text_input("Meta do Mês (Calculada)", value=str(meta_calculada), disabled=True)
     with c5: st.text_input("Meta -25% (Calculada)", value=str(meta_min), disabled=True)
     with c6: st.text_input("Meta +25% (Calculada)", value=str(meta_max), disabled=True)
 
+    # Só desenha com o toggle ligado; com os mesmos dados, vem do cache de renderização
+    if st.toggle("Mostrar atendimentos face à meta nos últimos meses", key="ver_tendencia"):
+        try:
+            dados_hist = graficos.historico(catalogo.obter_catalogo().listar(), {k: st.session_state.get(k) for k in FORM_KEYS})
+            png_tendencia = graficos.gerar_grafico("ATENDIMENTOS_META", dados_hist)
+            if png_tendencia is None:
+                st.caption("Sem totais de atendimentos para mostrar.")
+            else:
+                st.image(png_tendencia, use_container_width=True)
+        except Exception as e:
+            st.warning(f"Não foi possível gerar o gráfico: {e}")
+
     st.markdown("---")
     st.markdown("### Dados Assistenciais")
     c7, c8, c9 = st.columns(3)
@@ -393,25 +376,46 @@ with t_evidencia:
                 st.markdown(f"<span class='upload-label'>{labels.get(m, m)}</span>", unsafe_allow_html=True)
                 ca, cb = st.columns([1, 1])
                 with ca:
-                    key_p = f"p_{m}_{len(st.session_state.dados_sessao[m])}"
-                    pasted = paste_image_button(label="Colar Print", key=key_p)
+                    # Nova key depois de cada colagem/upload (mesmo recusado por repetido): o widget
+                    # solta o conteúdo, que passa a viver só no armazém
+                    gen = st.session_state.upload_gen.get(m, 0)
+                    pasted = paste_image_button(label="Colar Print", key=f"p_{m}_{gen}")
                     if pasted is not None and pasted.image_data is not None:
-                        st.session_state.dados_sessao[m].append({"name": f"Captura_{len(st.session_state.dados_sessao[m]) + 1}.png", "content": pasted.image_data, "type": "p"})
-                        st.toast(f"Anexado em: {labels[m]}")
+                        # Codificado uma única vez; render, salvamento e backup reutilizam estes bytes
+                        png = motor_relatorio.dados_conteudo(pasted.image_data)
+                        st.session_state.upload_gen[m] = gen + 1
+                        if anexar_evidencia(m, png, f"Captura_{len(st.session_state.dados_sessao[m]) + 1}.png", "p"):
+                            st.toast(f"Anexado em: {labels[m]}")
                         time.sleep(0.5)
                         st.rerun()
                 with cb:
-                    f_up = st.file_uploader("Upload", type=['png', 'jpg', 'pdf', 'xlsx'], key=f"f_{m}_{b_idx}", label_visibility="collapsed")
+                    f_up = st.file_uploader("Upload", type=['png', 'jpg', 'pdf', 'xlsx', 'xls'], key=f"f_{m}_{b_idx}_{gen}", label_visibility="collapsed")
                     if f_up:
-                        if f_up.name not in [x['name'] for x in st.session_state.dados_sessao[m]]:
-                            st.session_state.dados_sessao[m].append({"name": f_up.name, "content": f_up, "type": "f"})
-                            st.rerun()
+                        anexar_evidencia(m, f_up.getvalue(), f_up.name, "f")
+                        st.session_state.upload_gen[m] = gen + 1
+                        time.sleep(0.5)
+                        st.rerun()
+                if m in graficos.GRAFICOS:
+                    if st.button("📈 Gerar com os dados do formulário", key=f"g_{m}"):
+                        try:
+                            anexar_grafico(m)
+                        except Exception as e:
+                            st.toast(f"⚠️ Não foi possível gerar o gráfico: {e}")
+                        time.sleep(0.5)
+                        st.rerun()
                 if st.session_state.dados_sessao[m]:
                     for i_idx, item in enumerate(st.session_state.dados_sessao[m]):
                         with st.expander(f"{item['name']}", expanded=False):
-                            is_image = item['type'] == "p" or item['name'].lower().endswith(('.png', '.jpg', '.jpeg'))
-                            if is_image:
-                                st.image(item['content'], use_container_width=True)
+                            # Miniatura gerada uma vez por conteúdo; o original nunca vai para o browser
+                            mini, meta = miniaturas.miniatura(item)
+                            if mini is not None:
+                                st.image(mini, use_container_width=True)
+                            if "paginas" in meta:
+                                st.caption(f"PDF com {meta['paginas']} página(s) · {item.get('size', 0) / 1024 / 1024:.1f} MB")
+                            elif "largura" in meta:
+                                st.caption(f"{meta['largura']}×{meta['altura']} px · {item.get('size', 0) / 1024:.0f} KB")
+                            elif "erro" in meta:
+                                st.warning(f"Pré-visualização indisponível: {meta['erro']}")
                             else:
                                 st.info(f"Ficheiro {item['name'].split('.')[-1].upper()} pronto para o relatório.")
                             if st.button("Remover", key=f"del_{m}_{i_idx}_{b_idx}"):
@@ -419,61 +423,98 @@ with t_evidencia:
                                 st.rerun()
         st.markdown('</div>', unsafe_allow_html=True)
 
+def mostrar_diagnostico(execucao):
+    """Painel com os spans da geração (e o perfil, se foi capturado)."""
+    spans = execucao.tabela()
+    if not spans: return
+    with st.expander("Diagnóstico da geração", expanded=False):
+        df = pd.DataFrame([{
+            "Etapa": "  " * s["nivel"] + s["nome"],
+            "Marcador": s.get("marcador", ""),
+            "Detalhe": s.get("evidencia") or (f"página {s['pagina']} ({s['processo']})" if "pagina" in s else ""),
+            "Tempo (s)": round(s["segundos"], 3),
+            "Saída (KB)": round(s.get("bytes", 0) / 1024, 1),
+            "Memória Δ (MB)": round(s.get("memoria_delta", 0) / 1024 / 1024, 1),
+            "Cache": s.get("cache", ""),
+        } for s in spans])
+        lentos = sorted((s for s in spans if s["nome"] in ("item", "render", "save", "converter")),
+                        key=lambda s: s["segundos"], reverse=True)[:3]
+        st.caption("Mais lentos: " + ", ".join(f"{s.get('evidencia') or s['nome']} ({s['segundos']:.1f}s)" for s in lentos))
+        st.dataframe(df, hide_index=True, use_container_width=True)
+        if execucao.relatorio_perfil:
+            st.code(execucao.relatorio_perfil, language=None)
+        st.caption(f"Registado em {diagnostico.DIAGNOSTICO_LOG} (execução {execucao.id}).")
+
 # --- GERAÇÃO FINAL ---
-if st.button(" FINALIZAR E GERAR RELATÓRIO", type="primary"):
-    try:
-        with tempfile.TemporaryDirectory() as tmp:
-            docx_p = os.path.join(tmp, "relatorio.docx")
-            doc = DocxTemplate("template-upa-nova-cidade.docx")
-            
-            # PROTEÇÃO CONTRA VAZIOS: Garantir que chaves inexistentes ou vazias não quebrem a lógica
-            dados_finais = {
-                "SISTEMA_MES_REFERENCIA": f"{st.session_state.get('sel_mes', 'Janeiro')}/{st.session_state.get('sel_ano', 2026)}",
-                "ANALISTA_TOTAL_ATENDIMENTOS": st.session_state.get("in_total", ""),
-                "TOTAL_RAIO_X": st.session_state.get("in_rx", ""),
-                "ANALISTA_META_MES": str(meta_calculada),
-                "ANALISTA_META_MINUS_25": str(meta_min),
-                "ANALISTA_META_PLUS_25": str(meta_max),
-                "ANALISTA_MEDICO_CLINICO": st.session_state.get("in_mc", ""),
-                "ANALISTA_MEDICO_PEDIATRA": st.session_state.get("in_mp", ""),
-                "ANALISTA_ODONTO_CLINICO": st.session_state.get("in_oc", ""),
-                "ANALISTA_ODONTO_PED": st.session_state.get("in_op", ""),
-                "TOTAL_PACIENTES_CCIH": st.session_state.get("in_ccih", ""),
-                "OUVIDORIA_INTERNA": st.session_state.get("in_oi", ""),
-                "OUVIDORIA_EXTERNA": st.session_state.get("in_oe", ""),
-                "SISTEMA_TOTAL_DE_TRANSFERENCIA": st.session_state.get("in_tt", 0),
-                "SISTEMA_TAXA_DE_TRANSFERENCIA": st.session_state.get("in_taxa", ""),
-                "ANALISTA_TOTAL_OBITO": st.session_state.get("in_to", 0),
-                "ANALISTA_OBITO_MENOR": st.session_state.get("in_to_menor", 0),
-                "ANALISTA_OBITO_MAIOR": st.session_state.get("in_to_maior", 0),
-                "SISTEMA_TOTAL_MEDICOS": int(st.session_state.get("in_mc", 0) or 0) + int(st.session_state.get("in_mp", 0) or 0)
-            }
+def _armar_perfil():
+    # O perfil vale só para esta geração: a opção é desligada logo a seguir
+    st.session_state.perfil_geracao = st.session_state.get("diag_perfil", False)
+    st.session_state.diag_perfil = False
 
-            for marcador in DIMENSOES_CAMPOS.keys():
-                lista_imgs = []
-                for item in st.session_state.dados_sessao.get(marcador, []):
-                    res = processar_item_lista(doc, item['content'], marcador)
-                    if res: lista_imgs.extend(res)
-                dados_finais[marcador] = lista_imgs
-            
-            doc.render(dados_finais)
-            doc.save(docx_p)
-            
-            st.success("✅ Relatório gerado!")
+st.checkbox("Capturar perfil detalhado (cProfile + tracemalloc) na próxima geração", key="diag_perfil")
+if st.button(" FINALIZAR E GERAR RELATÓRIO", type="primary", on_click=_armar_perfil):
+    try:
+        trabalho = fila_relatorios.obter_servico().submeter(
+            {k: st.session_state.get(k) for k in FORM_KEYS}, st.session_state.dados_sessao,
+            perfil=st.session_state.pop("perfil_geracao", False),
+        )
+        st.session_state.trabalho_id = trabalho.id
+    except fila_relatorios.FilaCheia as e:
+        st.warning(str(e))
+
+def painel_trabalho(em_curso):
+    """Progresso do trabalho em curso e, no fim, o resultado com os downloads."""
+    trabalho = fila_relatorios.obter_servico().obter(st.session_state.get("trabalho_id"))
+    if trabalho is None:
+        return
+    if not trabalho.terminado:
+        feitos, total = trabalho.marcadores
+        etapas = {"render": "A montar o documento...", "save": "A gravar o DOCX...", "converter": "A converter para PDF..."}
+        texto = etapas.get(trabalho.etapa) or ("Na fila..." if trabalho.estado == fila_relatorios.NA_FILA else
+                                               f"Marcadores: {feitos}/{total} · páginas rasterizadas: {trabalho.paginas}")
+        st.progress(feitos / total if total else 0.0, text=texto)
+        if st.button("Cancelar geração", key="btn_cancelar_geracao"):
+            trabalho.cancelar()
+        return
+    if em_curso:
+        # Terminou durante o polling: um rerun da página inteira mostra o resultado e para o polling
+        st.rerun()
+    if trabalho.estado == fila_relatorios.CANCELADO:
+        st.info("Geração cancelada.")
+    elif trabalho.estado == fila_relatorios.ERRO:
+        st.error(f"Erro na geração: {trabalho.erro}")
+    else:
+        st.success("✅ Relatório gerado!" if not trabalho.memoizado else "✅ Relatório gerado! (sem alterações desde a última geração)")
+        if trabalho.estatisticas:
+            with st.expander("Otimização de imagens por marcador", expanded=False):
+                st.dataframe(pd.DataFrame([
+                    {"Marcador": m, "Original (KB)": round(a / 1024, 1), "No relatório (KB)": round(d / 1024, 1),
+                     "Poupança (%)": round(100 * (1 - d / a), 1) if a else 0.0}
+                    for m, (a, d) in trabalho.estatisticas.items()
+                ]), hide_index=True, use_container_width=True)
+        mes_ref = trabalho.form_state.get('sel_mes')
+        if not os.path.exists(trabalho.resultado["docx"]):
+            # Podado (ex.: servidor limpo à mão) depois de o trabalho terminar
+            st.warning("Resultado expirado: gere o relatório novamente.")
+        else:
             c_down1, c_down2 = st.columns(2)
             with c_down1:
-                with open(docx_p, "rb") as f_w:
-                    st.download_button(label="Baixar WORD (.docx)", data=f_w.read(), file_name=f"RELATÓRIO ASSISTENCIAL MENSAL - NOVA CIDADE {st.session_state.get('sel_mes')}.docx")
+                # Lido só quando o botão é clicado, não em cada rerun
+                st.download_button(label="Baixar WORD (.docx)", data=lambda p=trabalho.resultado["docx"]: _ler_ficheiro(p),
+                                   file_name=f"RELATÓRIO ASSISTENCIAL MENSAL - NOVA CIDADE {mes_ref}.docx")
             with c_down2:
-                try:
-                    converter_para_pdf(docx_p, tmp)
-                    pdf_p = os.path.join(tmp, "relatorio.pdf")
-                    if os.path.exists(pdf_p):
-                        with open(pdf_p, "rb") as f_p:
-                            st.download_button(label="Baixar PDF", data=f_p.read(), file_name=f"RELATÓRIO ASSISTENCIAL MENSAL - NOVA CIDADE {st.session_state.get('sel_mes')}.pdf")
-                except: st.warning("Conversão PDF indisponível.")
-    except Exception as e:
-        st.error(f"Erro na geração: {e}")
+                if trabalho.resultado["pdf"] and os.path.exists(trabalho.resultado["pdf"]):
+                    st.download_button(label="Baixar PDF", data=lambda p=trabalho.resultado["pdf"]: _ler_ficheiro(p),
+                                       file_name=f"RELATÓRIO ASSISTENCIAL MENSAL - NOVA CIDADE {mes_ref}.pdf")
+                    if trabalho.resultado.get("aviso_pdf"): st.caption(trabalho.resultado["aviso_pdf"])
+                else: st.warning("Conversão PDF indisponível.")
+    mostrar_diagnostico(trabalho.execucao)
+
+# O trabalho corre em segundo plano; enquanto corre, só este painel é refeito a cada segundo
+trabalho = fila_relatorios.obter_servico().obter(st.session_state.get("trabalho_id"))
+if trabalho is not None:
+    em_curso = not trabalho.terminado
+    st.fragment(painel_trabalho, run_every=1 if em_curso else None)(em_curso)
 
 st.caption("Desenvolvido por Leonardo Barcelos Martins")
 
@@ -0,0 +1,178 @@
+"""Armazém das evidências da sessão em disco, para limitar a memória por sessão.
+
+``st.session_state.dados_sessao`` guarda apenas *handles* leves
+(``{"name", "type", "sha256", "size"}``); os bytes ficam em ficheiros
+endereçados por conteúdo numa pasta do servidor, partilhada por todas as
+sessões do processo, e são lidos via ``mmap`` quando é preciso renderizá-los.
+
+As evidências de um relatório carregado entram com ``importar``: o blob do
+relatório salvo é ligado (hard link) ao armazém, sem copiar os bytes, e o
+handle da sessão continua válido mesmo que a recolha de lixo dos blobs o
+apague entretanto (ex.: o relatório foi salvo de novo sem essa evidência).
+
+Nada dos conteúdos fica em memória por sessão: as pré-visualizações vêm das
+miniaturas (``miniaturas``), numa cache partilhada e limitada em bytes.
+
+Como os handles são identificados pelo sha256, a mesma evidência anexada duas
+vezes (colada de novo, ou enviada com outro nome) é detetada com ``localizar``
+antes de entrar na sessão.
+"""
+import contextlib
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+EVIDENCIAS_DIR = Path(os.environ.get(
+    "EVIDENCIAS_DIR", os.path.join(tempfile.gettempdir(), "evidencias_novacidade")
+))
+# Ficheiros sem acesso há mais do que isto são apagados no arranque
+VALIDADE_SEGUNDOS = int(os.environ.get("EVIDENCIAS_VALIDADE_DIAS", 7)) * 24 * 3600
+
+
+class ArmazemEvidencias:
+    def __init__(self, pasta=EVIDENCIAS_DIR):
+        self.pasta = Path(pasta)
+        self.pasta.mkdir(parents=True, exist_ok=True)
+        self._limpar_antigos()
+
+    def _limpar_antigos(self):
+        limite = time.time() - VALIDADE_SEGUNDOS
+        for p in self.pasta.glob("*/*"):
+            try:
+                if p.stat().st_mtime < limite:
+                    p.unlink()
+            except OSError:
+                pass
+
+    def caminho(self, sha):
+        return self.pasta / sha[:2] / sha
+
+    def existe(self, sha):
+        return self.caminho(sha).exists()
+
+    def adicionar(self, data, nome, tipo, sha=None):
+        """Guarda ``data`` (bytes) e devolve o handle da evidência."""
+        sha = sha or hashlib.sha256(data).hexdigest()
+        destino = self.pasta / sha[:2] / sha
+        if destino.exists():
+            os.utime(destino)
+        else:
+            destino.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=destino.parent)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, destino)
+        return {"name": nome, "type": tipo, "sha256": sha, "size": len(data)}
+
+    def adicionar_stream(self, leitor, nome, tipo, limite=None, bloco=1024 * 1024):
+        """Como ``adicionar``, mas lê ``leitor`` por blocos, sem o carregar todo em memória.
+
+        Levanta ``ValueError`` se passar de ``limite`` bytes.
+        """
+        self.pasta.mkdir(parents=True, exist_ok=True)
+        h = hashlib.sha256()
+        tamanho = 0
+        fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=self.pasta)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for dados in iter(lambda: leitor.read(bloco), b""):
+                    tamanho += len(dados)
+                    if limite is not None and tamanho > limite:
+                        raise ValueError(f"excede o limite de {limite} bytes")
+                    h.update(dados)
+                    f.write(dados)
+            sha = h.hexdigest()
+            destino = self.pasta / sha[:2] / sha
+            if destino.exists():
+                os.remove(tmp)
+                os.utime(destino)
+            else:
+                destino.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp, destino)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        return {"name": nome, "type": tipo, "sha256": sha, "size": tamanho}
+
+    def importar(self, origem, nome, tipo, sha):
+        """Traz para o armazém o ficheiro ``origem``, cujo conteúdo já se sabe ser ``sha``.
+
+        Cria uma ligação física (os dois nomes partilham os mesmos bytes);
+        noutro sistema de ficheiros, ou onde não haja ligações, copia.
+        """
+        destino = self.caminho(sha)
+        if not destino.exists():
+            destino.parent.mkdir(parents=True, exist_ok=True)
+            tmp = destino.with_name(f".tmp_{uuid.uuid4().hex}")
+            try:
+                try:
+                    os.link(origem, tmp)
+                except OSError:
+                    shutil.copyfile(origem, tmp)
+                os.replace(tmp, destino)
+            except BaseException:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise
+        # Conta como usada agora para a limpeza por idade (no blob também, que partilha o inode)
+        os.utime(destino)
+        return {"name": nome, "type": tipo, "sha256": sha, "size": destino.stat().st_size}
+
+    @contextlib.contextmanager
+    def abrir(self, sha):
+        """Mapeia o ficheiro da evidência em memória (só leitura) enquanto o contexto durar."""
+        caminho = self.caminho(sha)
+        os.utime(caminho)
+        with open(caminho, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b""
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+
+    def ler(self, sha):
+        """Bytes da evidência (para quem precisa deles todos, ex.: gravar noutro armazém)."""
+        with self.abrir(sha) as mm:
+            return bytes(mm)
+
+
+ARMAZEM = ArmazemEvidencias()
+
+
+def localizar(evidencias, sha):
+    """Marcador e handle de ``evidencias`` com o conteúdo ``sha``, ou ``None``."""
+    for marcador, itens in evidencias.items():
+        for item in itens:
+            if item["sha256"] == sha:
+                return marcador, item
+    return None
+
+
+def deduplicar(evidencias):
+    """Remove os itens repetidos (mesmo sha256), mantendo a primeira ocorrência.
+
+    Devolve ``(evidencias, repetidos)``, com ``repetidos`` uma lista de
+    ``(marcador, item, marcador_original, item_original)``.
+    """
+    vistos = {}
+    resultado, repetidos = {}, []
+    for marcador, itens in evidencias.items():
+        resultado[marcador] = []
+        for item in itens:
+            original = vistos.get(item["sha256"])
+            if original is not None:
+                repetidos.append((marcador, item) + original)
+                continue
+            vistos[item["sha256"]] = (marcador, item)
+            resultado[marcador].append(item)
+    return resultado, repetidos
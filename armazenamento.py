@@ -0,0 +1,120 @@
+"""Persistência dos relatórios salvos num repositório de blobs endereçado por conteúdo.
+
+Cada evidência é gravada uma única vez em ``_blobs/<aa>/<sha256>``, partilhada
+por todos os relatórios e versões; a pasta de cada relatório guarda apenas o
+manifesto ``estado.json`` (estado do formulário + lista de evidências com o
+hash de cada uma). Salvar só escreve os blobs novos e o manifesto é
+substituído de forma atómica. ``coletar_lixo`` remove os blobs que nenhum
+manifesto referencia.
+
+Manifestos antigos (com ``"file": "evidencias/..."``) continuam a ser lidos.
+
+Uso: ``python armazenamento.py --gc`` para recolher os blobs órfãos.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BASE_RELATORIOS_DIR = Path("relatorios_salvos_novacidade")
+PASTA_BLOBS = "_blobs"
+# Blobs mais recentes do que isto nunca são recolhidos: podem pertencer a um
+# salvamento em curso cujo manifesto ainda não foi escrito.
+CARENCIA_GC_SEGUNDOS = 3600
+
+
+def gravar_atomico(caminho, data):
+    """Escreve ``data`` num temporário da mesma pasta e troca-o por ``caminho``."""
+    caminho = Path(caminho)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp_", dir=caminho.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, caminho)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class ArmazemBlobs:
+    def __init__(self, base=BASE_RELATORIOS_DIR):
+        self.base = Path(base)
+        self.pasta = self.base / PASTA_BLOBS
+
+    def caminho(self, sha):
+        return self.pasta / sha[:2] / sha
+
+    def existe(self, sha):
+        return self.caminho(sha).exists()
+
+    def gravar(self, data, sha=None):
+        """Grava ``data`` se ainda não existir e devolve o seu sha256."""
+        sha = sha or hashlib.sha256(data).hexdigest()
+        destino = self.caminho(sha)
+        if not destino.exists():
+            destino.parent.mkdir(parents=True, exist_ok=True)
+            gravar_atomico(destino, data)
+        return sha
+
+    def ler(self, sha):
+        return self.caminho(sha).read_bytes()
+
+    def manifestos(self):
+        for p in self.base.iterdir():
+            if p.is_dir() and p.name != PASTA_BLOBS and (p / "estado.json").exists():
+                yield p / "estado.json"
+
+    def referenciados(self):
+        hashes = set()
+        for manifesto in self.manifestos():
+            with open(manifesto, "r", encoding="utf-8") as f:
+                estado = json.load(f)
+            for lista in estado.get("evidencias", {}).values():
+                hashes.update(meta["sha256"] for meta in lista if "sha256" in meta)
+        return hashes
+
+    def coletar_lixo(self, carencia=CARENCIA_GC_SEGUNDOS):
+        """Remove os blobs não referenciados. Devolve ``(quantidade, bytes)`` libertados."""
+        if not self.pasta.exists():
+            return 0, 0
+        vivos = self.referenciados()
+        limite = time.time() - carencia
+        removidos, libertados = 0, 0
+        for blob in self.pasta.glob("*/*"):
+            info = blob.stat()
+            if blob.name not in vivos and info.st_mtime < limite:
+                blob.unlink()
+                removidos += 1
+                libertados += info.st_size
+        return removidos, libertados
+
+
+def salvar_manifesto(pasta, form_state, evidencias):
+    """Substitui o ``estado.json`` de ``pasta`` de forma atómica.
+
+    ``evidencias`` é ``{marcador: [{"name", "type", "sha256", "size"}, ...]}``,
+    com os blobs já gravados no armazém. A antiga pasta ``evidencias/`` (formato
+    anterior) deixa de ser referenciada e é apagada.
+    """
+    pasta = Path(pasta)
+    pasta.mkdir(parents=True, exist_ok=True)
+    estado = {"versao": 2, "form_state": form_state, "evidencias": evidencias}
+    gravar_atomico(pasta / "estado.json", json.dumps(estado, ensure_ascii=False, indent=2).encode("utf-8"))
+    shutil.rmtree(pasta / "evidencias", ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if "--gc" not in sys.argv[1:]:
+        print(__doc__)
+        sys.exit(0)
+    n, b = ArmazemBlobs().coletar_lixo()
+    print(f"{n} blobs removidos ({b / 1024 / 1024:.1f} MB libertados)")
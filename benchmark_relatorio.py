@@ -0,0 +1,414 @@
+"""Benchmark da geração de relatórios com evidências sintéticas.
+
+Gera, para cada marcador de ``DIMENSOES_CAMPOS``, um corpus sintético (prints
+colados, fotos grandes, PDFs de várias páginas e planilhas .xlsx) e mede cada
+etapa em separado: ingestão no armazém de evidências, ``processar_item_lista``
+(com o cache de renderização vazio e depois cheio), ``doc.render``,
+``doc.save``, conversão para PDF e backup ZIP (escrita e restauro).
+
+Para cada etapa regista o tempo (mediana das repetições), o pico de RSS do
+processo e o tamanho da saída, e grava tudo em JSON. Uma etapa que falhe —
+incluindo ``processar_item_lista`` quando alguma evidência do corpus não dá
+nenhuma imagem — fica registada com o erro e o benchmark termina com código 1.
+Com ``--baseline`` compara com um resultado anterior e termina também com
+código 1 se alguma etapa piorar mais do que a tolerância.
+
+Exemplos::
+
+    python benchmark_relatorio.py --escala rapida --sem-pdf
+    python benchmark_relatorio.py --saida atual.json --baseline baseline.json
+    python benchmark_relatorio.py --saida baseline.json   # nova baseline
+
+O armazém de evidências e o cache de renderização usam pastas temporárias
+próprias, para não interferirem com os da aplicação.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Quantidades por marcador em cada escala. Os PDFs têm sempre pelo menos
+# ``rasterizacao_pdf.MIN_PAGINAS_PARALELO`` páginas, para a rasterização em
+# paralelo (pool de processos) entrar também na medição
+ESCALAS = {
+    "rapida": {"prints": 1, "fotos": 1, "pdfs": 1, "paginas_pdf": 8, "planilhas": 1, "linhas_xlsx": 40},
+    "padrao": {"prints": 3, "fotos": 1, "pdfs": 1, "paginas_pdf": 8, "planilhas": 1, "linhas_xlsx": 300},
+    "grande": {"prints": 6, "fotos": 3, "pdfs": 2, "paginas_pdf": 30, "planilhas": 1, "linhas_xlsx": 2000},
+}
+
+ETAPAS = [
+    "ingestao", "processar_item_lista_frio", "processar_item_lista_quente",
+    "render", "save", "converter_pdf", "backup_zip", "restaurar_backup",
+]
+
+FORM_STATE = {
+    "sel_mes": "março", "sel_ano": 2026, "in_total": "7412", "in_rx": "1530",
+    "in_mc": "6100", "in_mp": "1312", "in_oc": "140", "in_op": "35", "in_ccih": "12",
+    "in_oi": "9", "in_oe": "4", "in_taxa": "1,8%", "in_tt": 133, "in_to": 6,
+    "in_to_menor": 2, "in_to_maior": 4,
+}
+
+
+# --- CORPUS SINTÉTICO ---
+def _print_sintetico(i):
+    """Captura de ecrã: fundo liso, barras e texto (poucas cores, muito texto)."""
+    from PIL import Image, ImageDraw
+    img = Image.new("RGB", (1600, 900), "white")
+    d = ImageDraw.Draw(img)
+    d.rectangle([0, 0, 1600, 60], fill=(40, 167, 69))
+    d.text((20, 20), f"Sistema de gestão - tela {i}", fill="white")
+    for lin in range(30):
+        y = 80 + lin * 26
+        d.rectangle([20, y, 1580, y + 22], fill=(240, 242, 245) if lin % 2 else "white")
+        d.text((30, y + 5), f"Paciente {i:03d}-{lin:03d}   classificação {'AVVA'[lin % 4]}   {lin * 7 % 60:02d} min", fill=(55, 65, 81))
+        d.rectangle([1200, y + 4, 1200 + (lin * 37 + i * 11) % 360, y + 18], fill=(31, 119, 180))
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _foto_sintetica(i):
+    """Foto de câmara: 12 MP, gradientes com ruído, JPEG de alta qualidade."""
+    import numpy as np
+    from PIL import Image
+    rng = np.random.default_rng(i)
+    alt, larg = 3000, 4000
+    y, x = np.mgrid[0:alt, 0:larg]
+    base = np.stack([(x * 255 // larg), (y * 255 // alt), ((x + y) * 255 // (alt + larg))], axis=-1)
+    ruido = rng.integers(-24, 24, size=(alt, larg, 3))
+    img = Image.fromarray(np.clip(base + ruido, 0, 255).astype("uint8"), "RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=92)
+    return buf.getvalue()
+
+
+def _pdf_sintetico(i, paginas):
+    import fitz
+    doc = fitz.open()
+    for p in range(paginas):
+        pag = doc.new_page()
+        pag.insert_text((72, 72), f"Relatório interno {i} - página {p + 1}", fontsize=16)
+        for lin in range(40):
+            pag.insert_text((72, 110 + lin * 16), f"Linha {lin:02d}: registo de ocorrência {i}.{p}.{lin}", fontsize=10)
+        pag.draw_rect(fitz.Rect(360, 110, 360 + 10 * (p % 18 + 1), 300), color=(0, 0.5, 0.2), fill=(0.2, 0.7, 0.3))
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def _xlsx_sintetico(i, linhas):
+    import datetime
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(["Data", "Prontuário", "Paciente", "Origem", "Destino", "Motivo", "Tempo (h)", "Situação"])
+    inicio = datetime.date(2026, 3, 1)
+    for r in range(linhas):
+        ws.append([inicio + datetime.timedelta(days=r % 31), 100000 + i * 10000 + r, f"Paciente {r:05d}",
+                   "UPA Nova Cidade", f"Hospital {r % 7}", ["Cirurgia", "UTI", "Pediatria"][r % 3],
+                   round((r * 1.37) % 48, 2), "Concluída" if r % 5 else "Pendente"])
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+
+def gerar_corpus(marcadores, escala):
+    """Devolve ``{marcador: [(nome, bytes, tipo), ...]}`` com a mistura da escala."""
+    q = ESCALAS[escala]
+    # Os ficheiros repetem-se entre marcadores como nos relatórios reais, mas
+    # com conteúdo diferente por marcador para não serem deduplicados
+    corpus = {}
+    for n, m in enumerate(marcadores):
+        itens = []
+        for i in range(q["prints"]):
+            itens.append((f"Captura_{i + 1}.png", _print_sintetico(n * 100 + i), "p"))
+        for i in range(q["fotos"]):
+            itens.append((f"foto_{i + 1}.jpg", _foto_sintetica(n * 100 + i), "f"))
+        for i in range(q["pdfs"]):
+            itens.append((f"documento_{i + 1}.pdf", _pdf_sintetico(n * 100 + i, q["paginas_pdf"]), "f"))
+        for i in range(q["planilhas"]):
+            itens.append((f"planilha_{i + 1}.xlsx", _xlsx_sintetico(n * 100 + i, q["linhas_xlsx"]), "f"))
+        corpus[m] = itens
+    return corpus
+
+
+# --- MEDIÇÃO ---
+def _reiniciar_pico_rss():
+    # No Linux, escrever "5" em clear_refs reinicia o VmHWM do processo
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _pico_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for linha in f:
+                if linha.startswith("VmHWM:"):
+                    return int(linha.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource  # só existe em sistemas Unix
+    except ImportError:
+        return 0.0
+    # ru_maxrss é em KB no Linux e em bytes no macOS; é o pico desde o arranque
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico / (1024 * 1024) if sys.platform == "darwin" else pico / 1024
+
+
+class Medidor:
+    def __init__(self):
+        self.amostras = {e: [] for e in ETAPAS}
+
+    def medir(self, etapa, funcao):
+        """Executa ``funcao`` e regista tempo e pico de RSS. ``funcao`` devolve o tamanho da saída (bytes)."""
+        pico_isolado = _reiniciar_pico_rss()
+        inicio = time.perf_counter()
+        bytes_saida = funcao()
+        segundos = time.perf_counter() - inicio
+        self.amostras[etapa].append({
+            "segundos": segundos, "pico_rss_mb": _pico_rss_mb(),
+            "pico_isolado": pico_isolado, "bytes_saida": bytes_saida or 0,
+        })
+
+    def falhou(self, etapa, erro):
+        self.amostras[etapa].append({"erro": str(erro)})
+
+    def resumo(self):
+        etapas = {}
+        for etapa, amostras in self.amostras.items():
+            validas = [a for a in amostras if "erro" not in a]
+            erros = [a["erro"] for a in amostras if "erro" in a]
+            # Basta uma repetição falhar para a etapa contar como falhada
+            if erros:
+                etapas[etapa] = {"erro": erros[-1], "repeticoes_com_erro": len(erros)}
+                continue
+            if not validas:
+                continue
+            tempos = [a["segundos"] for a in validas]
+            etapas[etapa] = {
+                "segundos": statistics.median(tempos),
+                "segundos_min": min(tempos),
+                "segundos_max": max(tempos),
+                "pico_rss_mb": max(a["pico_rss_mb"] for a in validas),
+                "pico_isolado": all(a["pico_isolado"] for a in validas),
+                "bytes_saida": validas[-1]["bytes_saida"],
+                "repeticoes": len(validas),
+            }
+        return etapas
+
+
+def _versao_git():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# --- EXECUÇÃO ---
+def executar(escala, repeticoes, pdf, template, pasta_trabalho):
+    import armazem_evidencias
+    import cache_render
+    import cache_template
+    import motor_relatorio
+    import restauro_backup
+
+    armazem = armazem_evidencias.ARMAZEM
+    marcadores = list(motor_relatorio.DIMENSOES_CAMPOS.keys())
+    template = template or motor_relatorio.TEMPLATE_PADRAO
+
+    inicio = time.perf_counter()
+    corpus = gerar_corpus(marcadores, escala)
+    segundos_corpus = time.perf_counter() - inicio
+    bytes_corpus = sum(len(d) for itens in corpus.values() for _, d, _ in itens)
+
+    if pdf:
+        # Como na aplicação: os perfis do LibreOffice são criados antes do primeiro relatório
+        motor_relatorio.conversor_pdf.obter_servico()
+
+    medidor = Medidor()
+    for rep in range(repeticoes):
+        shutil.rmtree(armazem.pasta, ignore_errors=True)
+        armazem.pasta.mkdir(parents=True)
+        cache_render.CACHE.limpar()
+        saida = Path(pasta_trabalho) / f"rep_{rep}"
+        saida.mkdir()
+        evidencias = {}
+        contexto = {}
+        gerado = {}
+
+        def ingestao():
+            for m, itens in corpus.items():
+                evidencias[m] = [armazem.adicionar(data, nome, tipo) for nome, data, tipo in itens]
+            return sum(h["size"] for lista in evidencias.values() for h in lista)
+
+        def processar():
+            doc = cache_template.CACHE.obter(template)
+            contexto.clear()
+            contexto.update(motor_relatorio.montar_contexto(FORM_STATE))
+            estatisticas = {}
+            sem_imagens = []
+            for m in marcadores:
+                imgs = []
+                for item in evidencias.get(m, []):
+                    # Em caso de erro, processar_item_lista devolve [] em vez de levantar
+                    novas = motor_relatorio.processar_item_lista(doc, item, m, estatisticas)
+                    if not novas:
+                        sem_imagens.append(f"{m}/{item['name']}")
+                    imgs.extend(novas)
+                contexto[m] = imgs
+            gerado["doc"] = doc
+            if sem_imagens:
+                raise RuntimeError(f"{len(sem_imagens)} evidências sem imagens: {', '.join(sem_imagens[:5])}")
+            return sum(depois for _, depois in estatisticas.values())
+
+        docx_p = saida / "relatorio.docx"
+        zip_p = saida / "backup.zip"
+
+        def render():
+            gerado["doc"].render(contexto)
+
+        def save():
+            gerado["doc"].save(docx_p)
+            return docx_p.stat().st_size
+
+        def converter():
+            return Path(motor_relatorio.converter_para_pdf(str(docx_p), str(saida))).stat().st_size
+
+        def backup_zip():
+            motor_relatorio.escrever_backup_zip(FORM_STATE, evidencias, zip_p)
+            return zip_p.stat().st_size
+
+        def restaurar_backup():
+            _, handles, falhas = restauro_backup.restaurar(zip_p)
+            if falhas:
+                raise RuntimeError(f"{len(falhas)} evidências não restauradas: {falhas[0]['motivo']}")
+            return sum(h["size"] for lista in handles.values() for h in lista)
+
+        medidor.medir("ingestao", ingestao)
+        # Mesmo conteúdo outra vez: tudo deve vir do cache de renderização
+        for etapa in ("processar_item_lista_frio", "processar_item_lista_quente"):
+            try:
+                medidor.medir(etapa, processar)
+            except RuntimeError as e:
+                medidor.falhou(etapa, e)
+        medidor.medir("render", render)
+        medidor.medir("save", save)
+        if pdf:
+            try:
+                medidor.medir("converter_pdf", converter)
+            except Exception as e:
+                medidor.falhou("converter_pdf", e)
+        medidor.medir("backup_zip", backup_zip)
+        # O restauro volta a guardar no armazém: começa vazio, como numa sessão nova
+        shutil.rmtree(armazem.pasta, ignore_errors=True)
+        medidor.medir("restaurar_backup", restaurar_backup)
+        print(f"  repetição {rep + 1}/{repeticoes} concluída", file=sys.stderr)
+
+    return {
+        "versao": 1,
+        "data": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git": _versao_git(),
+        "ambiente": {
+            "python": platform.python_version(), "plataforma": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "parametros": {"escala": escala, "quantidades": ESCALAS[escala], "marcadores": len(marcadores),
+                       "repeticoes": repeticoes, "pdf": pdf, "template": Path(template).name},
+        "corpus": {"itens": sum(len(v) for v in corpus.values()), "bytes": bytes_corpus, "segundos_geracao": segundos_corpus},
+        "etapas": medidor.resumo(),
+    }
+
+
+# --- COMPARAÇÃO COM A BASELINE ---
+def comparar(atual, baseline, tolerancia):
+    """Devolve ``(linhas, regressoes)`` comparando ``atual`` com ``baseline``."""
+    linhas, regressoes = [], []
+    if atual["parametros"] != baseline.get("parametros"):
+        linhas.append("AVISO: parâmetros diferentes da baseline; a comparação é apenas indicativa.")
+    for etapa in ETAPAS:
+        a, b = atual["etapas"].get(etapa), baseline.get("etapas", {}).get(etapa)
+        if not a or not b or "erro" in a or "erro" in b:
+            continue
+        for campo, unidade in (("segundos", "s"), ("pico_rss_mb", "MB"), ("bytes_saida", "B")):
+            va, vb = a.get(campo, 0), b.get(campo, 0)
+            if not vb:
+                continue
+            variacao = (va - vb) / vb
+            marca = ""
+            # Tempos muito curtos variam demasiado para contarem como regressão
+            if variacao > tolerancia and not (campo == "segundos" and va < 0.05):
+                marca = "  <-- REGRESSÃO"
+                regressoes.append((etapa, campo, variacao))
+            linhas.append(f"{etapa:28s} {campo:12s} {vb:12.3f} -> {va:12.3f} {unidade:2s} ({variacao:+.1%}){marca}")
+    return linhas, regressoes
+
+
+def _imprimir(resultado):
+    print(f"\nCorpus: {resultado['corpus']['itens']} itens, {resultado['corpus']['bytes'] / 1024 / 1024:.1f} MB")
+    print(f"{'etapa':28s} {'tempo (s)':>10s} {'pico RSS (MB)':>14s} {'saída (MB)':>11s}")
+    for etapa in ETAPAS:
+        r = resultado["etapas"].get(etapa)
+        if r is None:
+            continue
+        if "erro" in r:
+            print(f"{etapa:28s} ERRO: {r['erro']}")
+            continue
+        print(f"{etapa:28s} {r['segundos']:10.3f} {r['pico_rss_mb']:14.1f} {r['bytes_saida'] / 1024 / 1024:11.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark da geração de relatórios com evidências sintéticas.")
+    parser.add_argument("--escala", choices=sorted(ESCALAS), default="padrao")
+    parser.add_argument("--repeticoes", type=int, default=3)
+    parser.add_argument("--sem-pdf", action="store_true", help="não mede a conversão para PDF")
+    parser.add_argument("--template", default=None, help="template .docx alternativo")
+    parser.add_argument("--saida", default="benchmark_resultado.json", help="JSON de resultados (padrão: %(default)s)")
+    parser.add_argument("--baseline", default=None, help="JSON de uma execução anterior para comparar")
+    parser.add_argument("--tolerancia", type=float, default=0.15, help="piora relativa aceite (padrão: %(default)s)")
+    args = parser.parse_args(argv)
+
+    pasta_trabalho = tempfile.mkdtemp(prefix="benchmark_relatorio_")
+    # Pastas isoladas, definidas antes de importar os módulos que as leem
+    os.environ["EVIDENCIAS_DIR"] = os.path.join(pasta_trabalho, "evidencias")
+    os.environ["CACHE_RENDER_DIR"] = os.path.join(pasta_trabalho, "cache_render")
+    try:
+        resultado = executar(args.escala, max(1, args.repeticoes), not args.sem_pdf, args.template, pasta_trabalho)
+    finally:
+        shutil.rmtree(pasta_trabalho, ignore_errors=True)
+
+    _imprimir(resultado)
+    with open(args.saida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    print(f"\nResultados gravados em {args.saida}")
+
+    falhas = [e for e, r in resultado["etapas"].items() if "erro" in r]
+    if falhas:
+        print(f"\nEtapas com erro: {', '.join(falhas)}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        linhas, regressoes = comparar(resultado, baseline, args.tolerancia)
+        print(f"\nComparação com {args.baseline} (tolerância {args.tolerancia:.0%}):")
+        print("\n".join(linhas))
+        if regressoes:
+            print(f"\n{len(regressoes)} regressões acima da tolerância.")
+            return 1
+    return 1 if falhas else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
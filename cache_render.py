@@ -0,0 +1,223 @@
+"""Cache de renderização das evidências, endereçado por conteúdo.
+
+Cada entrada guarda as imagens (PNG/JPEG) já renderizadas de uma evidência,
+mais um pequeno dicionário de metadados (ex.: bytes originais), e é
+identificada pelo hash do conteúdo, pelo marcador e pela largura do campo em
+``DIMENSOES_CAMPOS``. Há duas camadas, ambas LRU e limitadas em bytes: uma em
+memória (partilhada por todas as sessões do processo) e outra em disco (que
+sobrevive a reinícios do servidor).
+
+O lock protege só o índice em memória e os contadores; as leituras, escritas
+e podas do disco fazem-se fora dele, para um acesso lento ao disco não
+bloquear as outras sessões. Uma entrada no disco só aparece (``os.replace``)
+ou desaparece (renomeada antes de apagada) de uma vez.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+# Incrementar quando a forma de renderizar mudar, para invalidar o cache antigo.
+VERSAO_RENDER = "2"
+
+CACHE_RENDER_DIR = Path(os.environ.get(
+    "CACHE_RENDER_DIR", os.path.join(tempfile.gettempdir(), "cache_render_novacidade")
+))
+LIMITE_MEMORIA_BYTES = int(os.environ.get("CACHE_RENDER_MEMORIA_MB", 256)) * 1024 * 1024
+LIMITE_DISCO_BYTES = int(os.environ.get("CACHE_RENDER_DISCO_MB", 2048)) * 1024 * 1024
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def chave_render(hash_conteudo, marcador, largura, variante=""):
+    """Chave única de uma renderização: conteúdo + marcador + largura (mm)."""
+    base = f"{VERSAO_RENDER}|{hash_conteudo}|{marcador}|{largura}|{variante}"
+    return hashlib.sha256(base.encode("utf-8")).hexdigest()
+
+
+class CacheRender:
+    """LRU em memória + LRU em disco para listas de imagens renderizadas."""
+
+    def __init__(self, pasta=CACHE_RENDER_DIR, limite_memoria=LIMITE_MEMORIA_BYTES,
+                 limite_disco=LIMITE_DISCO_BYTES):
+        self.pasta = Path(pasta)
+        self.limite_memoria = limite_memoria
+        self.limite_disco = limite_disco
+        self._memoria = OrderedDict()
+        self._bytes_memoria = 0
+        self._bytes_disco = None
+        self._lock = threading.Lock()
+        # Uma poda de cada vez; quem chega a meio não espera por ela
+        self._lock_poda = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # --- memória (chamar com o lock) ---
+    def _guardar_memoria(self, chave, imagens, meta):
+        tamanho = sum(len(b) for b in imagens)
+        if tamanho > self.limite_memoria:
+            return
+        antigo = self._memoria.pop(chave, None)
+        if antigo is not None:
+            self._bytes_memoria -= sum(len(b) for b in antigo[0])
+        self._memoria[chave] = (imagens, meta)
+        self._bytes_memoria += tamanho
+        while self._bytes_memoria > self.limite_memoria and self._memoria:
+            _, (removido, _) = self._memoria.popitem(last=False)
+            self._bytes_memoria -= sum(len(b) for b in removido)
+
+    # --- disco (sem o lock) ---
+    def _pasta_chave(self, chave):
+        return self.pasta / chave[:2] / chave
+
+    def _ler_disco(self, chave):
+        destino = self._pasta_chave(chave)
+        if not destino.is_dir():
+            return None
+        try:
+            paginas = sorted(destino.glob("*.img"))
+            if not paginas:
+                return None  # podada entretanto
+            imagens = [p.read_bytes() for p in paginas]
+            caminho_meta = destino / "meta.json"
+            meta = json.loads(caminho_meta.read_text("utf-8")) if caminho_meta.exists() else {}
+            os.utime(destino)  # marca como usada recentemente
+            return imagens, meta
+        except (OSError, ValueError):
+            return None
+
+    def _medir_disco(self):
+        total = 0
+        for p in self.pasta.glob("*/*/*.img"):
+            try:
+                total += p.stat().st_size
+            except OSError:
+                pass  # apagada entretanto por uma poda
+        return total
+
+    def _somar_disco(self, tamanho):
+        """Conta ``tamanho`` bytes acabados de gravar e devolve o total no disco."""
+        with self._lock:
+            if self._bytes_disco is not None:
+                self._bytes_disco += tamanho
+                return self._bytes_disco
+        # Primeira gravação: a contagem já inclui a entrada nova
+        total = self._medir_disco()
+        with self._lock:
+            if self._bytes_disco is None:
+                self._bytes_disco = total
+            return self._bytes_disco
+
+    def _gravar_disco(self, chave, imagens, meta):
+        """Grava a entrada; devolve os bytes escritos (0 se já existia ou falhou)."""
+        destino = self._pasta_chave(chave)
+        if destino.is_dir():
+            return 0
+        try:
+            destino.parent.mkdir(parents=True, exist_ok=True)
+            tmp = Path(tempfile.mkdtemp(prefix=".tmp_", dir=destino.parent))
+        except OSError:
+            return 0
+        try:
+            for i, data in enumerate(imagens):
+                (tmp / f"{i:04d}.img").write_bytes(data)
+            if meta:
+                (tmp / "meta.json").write_text(json.dumps(meta), "utf-8")
+            os.replace(tmp, destino)  # a entrada só fica visível quando completa
+        except OSError:
+            # Inclui outra thread ter gravado a mesma chave primeiro
+            shutil.rmtree(tmp, ignore_errors=True)
+            return 0
+        return sum(len(b) for b in imagens)
+
+    def _podar_disco(self):
+        if not self._lock_poda.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                contados = self._bytes_disco or 0
+            entradas = []
+            for d in self.pasta.glob("*/*"):
+                if d.is_dir() and not d.name.startswith(".tmp_"):
+                    try:
+                        tamanho = sum(p.stat().st_size for p in d.glob("*.img"))
+                        entradas.append((d.stat().st_mtime, tamanho, d))
+                    except OSError:
+                        continue
+            entradas.sort()
+            total = sum(t for _, t, _ in entradas)
+            alvo = int(self.limite_disco * 0.9)
+            for _, tamanho, d in entradas:
+                if total <= alvo:
+                    break
+                # Renomeada primeiro: quem a esteja a ler falha por inteiro, não lê metade
+                lixo = d.with_name(f".tmp_podar_{d.name}")
+                try:
+                    os.replace(d, lixo)
+                except OSError:
+                    continue
+                shutil.rmtree(lixo, ignore_errors=True)
+                total -= tamanho
+            with self._lock:
+                # Mantém o que outras threads gravaram durante a poda
+                self._bytes_disco = max(0, (self._bytes_disco or 0) - contados + total)
+        finally:
+            self._lock_poda.release()
+
+    # --- API ---
+    def obter(self, chave):
+        """Devolve ``(imagens, meta)`` renderizados para ``chave`` ou ``None``."""
+        with self._lock:
+            entrada = self._memoria.get(chave)
+            if entrada is not None:
+                self._memoria.move_to_end(chave)
+                self.hits += 1
+                return entrada
+        entrada = self._ler_disco(chave)
+        with self._lock:
+            if entrada is None:
+                self.misses += 1
+                return None
+            self._guardar_memoria(chave, *entrada)
+            self.hits += 1
+            return entrada
+
+    def guardar(self, chave, imagens, meta=None):
+        imagens = [bytes(b) for b in imagens]
+        meta = dict(meta or {})
+        with self._lock:
+            self._guardar_memoria(chave, imagens, meta)
+        escritos = self._gravar_disco(chave, imagens, meta)
+        if escritos and self._somar_disco(escritos) > self.limite_disco:
+            self._podar_disco()
+
+    def obter_ou_renderizar(self, chave, renderizar):
+        """Procura ``chave`` no cache; em caso de falha chama ``renderizar()`` e guarda.
+
+        ``renderizar`` devolve ``(imagens, meta)``; o retorno tem a mesma forma.
+        """
+        entrada = self.obter(chave)
+        if entrada is None:
+            imagens, meta = renderizar()
+            imagens = list(imagens)
+            if imagens:
+                self.guardar(chave, imagens, meta)
+            entrada = (imagens, meta or {})
+        return entrada
+
+    def limpar(self):
+        with self._lock:
+            self._memoria.clear()
+            self._bytes_memoria = 0
+            # Volta a ser medido na próxima gravação
+            self._bytes_disco = None
+        shutil.rmtree(self.pasta, ignore_errors=True)
+
+
+CACHE = CacheRender()
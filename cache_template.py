@@ -0,0 +1,148 @@
+"""Cache do template DOCX já lido, analisado e compilado.
+
+O ficheiro é lido e analisado (python-docx) uma vez por processo; cada
+geração recebe uma cópia profunda do documento, que é muito mais barata do que
+voltar a abrir o ZIP e a interpretar o OOXML. A limpeza do XML feita pelo
+docxtpl (``patch_xml``) e a compilação Jinja de cada parte também ficam em
+cache, pois dependem apenas do template. Se o ``mtime`` ou o tamanho do
+ficheiro mudarem, o hash do conteúdo é recalculado e o template é recarregado
+quando for diferente.
+"""
+import copy
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from docxtpl import DocxTemplate
+from jinja2 import Environment
+
+MAX_ENTRADAS_XML = 64
+
+
+class _LRU:
+    def __init__(self, maximo):
+        self.maximo = maximo
+        self._dados = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def obter_ou_calcular(self, chave, calcular):
+        with self._lock:
+            if chave in self._dados:
+                self._dados.move_to_end(chave)
+                self.hits += 1
+                return self._dados[chave]
+            self.misses += 1
+        valor = calcular()
+        with self._lock:
+            self._dados[chave] = valor
+            while len(self._dados) > self.maximo:
+                self._dados.popitem(last=False)
+        return valor
+
+
+def _chave(texto):
+    return hashlib.sha256(texto.encode("utf-8")).digest()
+
+
+_XML_PREPARADO = _LRU(MAX_ENTRADAS_XML)
+_JINJA_COMPILADO = _LRU(MAX_ENTRADAS_XML)
+
+
+class _AmbienteJinja(Environment):
+    """Ambiente Jinja que compila cada fonte de template uma única vez."""
+
+    def from_string(self, source, globals=None, template_class=None):
+        if globals is not None or template_class is not None:
+            return super().from_string(source, globals, template_class)
+        return _JINJA_COMPILADO.obter_ou_calcular(_chave(source), lambda: super(_AmbienteJinja, self).from_string(source))
+
+
+AMBIENTE_JINJA = _AmbienteJinja()
+
+
+class TemplatePreparado(DocxTemplate):
+    """``DocxTemplate`` que reaproveita o XML limpo e o Jinja compilado."""
+
+    def patch_xml(self, src_xml):
+        return _XML_PREPARADO.obter_ou_calcular(_chave(src_xml), lambda: super(TemplatePreparado, self).patch_xml(src_xml))
+
+    def render(self, context, jinja_env=None, autoescape=False):
+        if jinja_env is None and not autoescape:
+            jinja_env = AMBIENTE_JINJA
+        super().render(context, jinja_env, autoescape)
+
+
+def _hash_ficheiro(caminho):
+    h = hashlib.sha256()
+    with open(caminho, "rb") as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(bloco)
+    return h.hexdigest()
+
+
+class CacheTemplate:
+    def __init__(self):
+        self._entradas = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.recargas = 0
+
+    def _carregar(self, caminho):
+        base = DocxTemplate(caminho)
+        base.init_docx()
+        return base.docx
+
+    def _entrada(self, caminho):
+        # Chamado com o lock adquirido
+        info = os.stat(caminho)
+        assinatura = (info.st_mtime_ns, info.st_size)
+        entrada = self._entradas.get(caminho)
+        if entrada is not None and entrada["assinatura"] != assinatura:
+            # O ficheiro foi tocado: só recarrega se o conteúdo mudou mesmo
+            sha = _hash_ficheiro(caminho)
+            if sha == entrada["sha256"]:
+                entrada["assinatura"] = assinatura
+            else:
+                entrada = None
+                self.recargas += 1
+        if entrada is None:
+            self.misses += 1
+            entrada = {"assinatura": assinatura, "sha256": _hash_ficheiro(caminho), "docx": self._carregar(caminho)}
+            self._entradas[caminho] = entrada
+        else:
+            self.hits += 1
+        return entrada
+
+    def obter(self, caminho):
+        """Devolve um ``TemplatePreparado`` pronto a renderizar, clonado do original em cache."""
+        caminho = str(Path(caminho).resolve())
+        with self._lock:
+            entrada = self._entrada(caminho)
+            clone = TemplatePreparado(caminho)
+            clone.docx = copy.deepcopy(entrada["docx"])
+        return clone
+
+    def sha256(self, caminho):
+        """Hash do conteúdo do template (recalculado só se o ficheiro mudar)."""
+        caminho = str(Path(caminho).resolve())
+        with self._lock:
+            return self._entrada(caminho)["sha256"]
+
+    def estatisticas(self):
+        return {
+            "template_hits": self.hits,
+            "template_misses": self.misses,
+            "template_recargas": self.recargas,
+            "xml_hits": _XML_PREPARADO.hits,
+            "xml_misses": _XML_PREPARADO.misses,
+            "jinja_hits": _JINJA_COMPILADO.hits,
+            "jinja_misses": _JINJA_COMPILADO.misses,
+        }
+
+
+CACHE = CacheTemplate()
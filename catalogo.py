@@ -0,0 +1,175 @@
+"""Catálogo SQLite dos relatórios salvos.
+
+Guarda, para cada relatório de ``relatorios_salvos_novacidade``, o mês e o
+ano, os principais totais do formulário, o número de evidências (total e por
+marcador) e o tamanho ocupado, para que o seletor de relatórios não precise
+de percorrer as pastas nem de abrir cada ``estado.json``. É atualizado a cada
+salvamento; ``sincronizar`` (corrido uma vez por processo) acerta o catálogo
+com as pastas existentes, incluindo relatórios salvos antes dele existir.
+
+Uso: ``python catalogo.py --reindexar`` reconstrói o catálogo a partir das pastas.
+"""
+import contextlib
+import json
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+import armazenamento
+from motor_relatorio import MESES_PT
+
+NOME_FICHEIRO = "catalogo.sqlite3"
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS relatorios (
+    nome TEXT PRIMARY KEY,
+    mes TEXT,
+    mes_num INTEGER,
+    ano INTEGER,
+    total_atendimentos INTEGER,
+    total_raio_x INTEGER,
+    total_transferencias INTEGER,
+    total_obitos INTEGER,
+    evidencias INTEGER,
+    evidencias_por_marcador TEXT,
+    bytes INTEGER,
+    form_state TEXT,
+    manifesto_mtime_ns INTEGER,
+    atualizado_em REAL
+);
+CREATE INDEX IF NOT EXISTS idx_relatorios_periodo ON relatorios (ano, mes_num);
+"""
+
+
+def _inteiro(valor):
+    try:
+        return int(str(valor).replace(".", "").strip() or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _tamanho(pasta, armazem, meta):
+    if "size" in meta:
+        return meta["size"]
+    p = armazem.caminho(meta["sha256"]) if "sha256" in meta else pasta / meta.get("file", "")
+    try:
+        return p.stat().st_size
+    except OSError:
+        return 0
+
+
+class Catalogo:
+    def __init__(self, base=armazenamento.BASE_RELATORIOS_DIR):
+        self.base = Path(base)
+        self.caminho = self.base / NOME_FICHEIRO
+        self.base.mkdir(parents=True, exist_ok=True)
+        with self._ligar() as con:
+            con.executescript(_ESQUEMA)
+
+    @contextlib.contextmanager
+    def _ligar(self):
+        con = sqlite3.connect(self.caminho, timeout=30)
+        con.row_factory = sqlite3.Row
+        try:
+            with con:  # commit no fim, rollback em caso de erro
+                yield con
+        finally:
+            con.close()
+
+    def registar(self, nome, form_state, evidencias, mtime_ns=None):
+        """Insere ou atualiza ``nome`` a partir do estado do formulário e da lista de evidências do manifesto."""
+        pasta = self.base / nome
+        armazem = armazenamento.ArmazemBlobs(self.base)
+        if mtime_ns is None:
+            mtime_ns = (pasta / "estado.json").stat().st_mtime_ns
+        por_marcador = {m: len(lista) for m, lista in evidencias.items() if lista}
+        tamanho = sum(_tamanho(pasta, armazem, meta) for lista in evidencias.values() for meta in lista)
+        mes = form_state.get("sel_mes") or ""
+        linha = {
+            "nome": nome, "mes": mes, "mes_num": MESES_PT.index(mes) + 1 if mes in MESES_PT else 0,
+            "ano": _inteiro(form_state.get("sel_ano")),
+            "total_atendimentos": _inteiro(form_state.get("in_total")),
+            "total_raio_x": _inteiro(form_state.get("in_rx")),
+            "total_transferencias": _inteiro(form_state.get("in_tt")),
+            "total_obitos": _inteiro(form_state.get("in_to")),
+            "evidencias": sum(por_marcador.values()),
+            "evidencias_por_marcador": json.dumps(por_marcador),
+            "bytes": tamanho,
+            "form_state": json.dumps(form_state, ensure_ascii=False, default=str),
+            "manifesto_mtime_ns": mtime_ns,
+            "atualizado_em": time.time(),
+        }
+        colunas = ", ".join(linha)
+        with self._ligar() as con:
+            con.execute(f"INSERT OR REPLACE INTO relatorios ({colunas}) VALUES ({', '.join('?' * len(linha))})",
+                        list(linha.values()))
+
+    def _registar_pasta(self, pasta):
+        manifesto = pasta / "estado.json"
+        with open(manifesto, "r", encoding="utf-8") as f:
+            estado = json.load(f)
+        self.registar(pasta.name, estado.get("form_state", {}), estado.get("evidencias", {}),
+                      manifesto.stat().st_mtime_ns)
+
+    def remover(self, nome):
+        with self._ligar() as con:
+            con.execute("DELETE FROM relatorios WHERE nome = ?", (nome,))
+
+    def listar(self):
+        """Relatórios do mais recente para o mais antigo (por ano e mês de referência)."""
+        with self._ligar() as con:
+            linhas = con.execute(
+                "SELECT * FROM relatorios ORDER BY ano DESC, mes_num DESC, nome"
+            ).fetchall()
+        return [dict(l) for l in linhas]
+
+    def obter(self, nome):
+        with self._ligar() as con:
+            linha = con.execute("SELECT * FROM relatorios WHERE nome = ?", (nome,)).fetchone()
+        return dict(linha) if linha else None
+
+    def sincronizar(self):
+        """Acerta o catálogo com as pastas: indexa as novas ou alteradas e esquece as apagadas."""
+        with self._ligar() as con:
+            conhecidos = dict(con.execute("SELECT nome, manifesto_mtime_ns FROM relatorios").fetchall())
+        no_disco = set()
+        for manifesto in armazenamento.ArmazemBlobs(self.base).manifestos():
+            pasta = manifesto.parent
+            no_disco.add(pasta.name)
+            if conhecidos.get(pasta.name) != manifesto.stat().st_mtime_ns:
+                try:
+                    self._registar_pasta(pasta)
+                except (OSError, ValueError):
+                    pass  # manifesto ilegível: fica fora do catálogo
+        for nome in set(conhecidos) - no_disco:
+            self.remover(nome)
+
+    def reindexar(self):
+        with self._ligar() as con:
+            con.execute("DELETE FROM relatorios")
+        self.sincronizar()
+
+
+_catalogo = None
+_catalogo_lock = threading.Lock()
+
+
+def obter_catalogo():
+    """Catálogo partilhado pelo processo, sincronizado com as pastas na primeira utilização."""
+    global _catalogo
+    with _catalogo_lock:
+        if _catalogo is None:
+            _catalogo = Catalogo()
+            _catalogo.sincronizar()
+        return _catalogo
+
+
+if __name__ == "__main__":
+    if "--reindexar" not in sys.argv[1:]:
+        print(__doc__)
+        sys.exit(0)
+    catalogo = Catalogo()
+    catalogo.reindexar()
+    print(f"{len(catalogo.listar())} relatórios indexados em {catalogo.caminho}")
@@ -0,0 +1,234 @@
+"""Serviço de conversão DOCX -> PDF com LibreOffice, partilhado pelo processo.
+
+O serviço é iniciado uma única vez: resolve o executável do LibreOffice,
+cria um perfil de utilizador isolado para cada trabalhador e aquece-o com uma
+conversão vazia (a criação do perfil é a parte mais lenta do arranque a frio).
+
+Só o perfil fica quente: cada conversão continua a lançar um ``soffice
+--convert-to`` novo, que arranca já com o perfil criado. Manter um LibreOffice
+à escuta (``--accept=...;urp;``) exigiria a ponte UNO (``import uno``), que só
+vem com o Python do próprio LibreOffice ou com o ``python3-uno`` do sistema,
+e não está disponível no ambiente Python da aplicação (``requirements.txt``).
+Os pedidos entram numa fila limitada e são atendidos por ``MAX_CONVERSOES``
+trabalhadores, cada um com o seu perfil, para que conversões simultâneas não
+disputem o mesmo ``UserInstallation``. Cada conversão tem um tempo limite; se o
+LibreOffice falhar ou bloquear, o processo é morto, o perfil é recriado e o
+trabalhador continua. Trabalhadores que morram são substituídos.
+
+Quem espera pela conversão pode interrompê-la (``verificar`` em
+``converter``): o pedido sai da fila ou, se já estiver a correr, o
+LibreOffice é morto.
+"""
+import atexit
+import os
+import platform
+import queue
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as TempoDeEsperaEsgotado
+from pathlib import Path
+
+MAX_CONVERSOES = int(os.environ.get("CONVERSOR_MAX_CONVERSOES", 2))
+TAMANHO_FILA = int(os.environ.get("CONVERSOR_TAMANHO_FILA", 8))
+TIMEOUT_CONVERSAO = int(os.environ.get("CONVERSOR_TIMEOUT", 180))
+# Intervalo (s) entre verificações de interrupção enquanto o LibreOffice corre
+INTERVALO_VERIFICACAO = 0.5
+
+_CAMINHOS_WINDOWS = [
+    r'C:\Program Files\LibreOffice\program\soffice.exe',
+    r'C:\Program Files (x86)\LibreOffice\program\soffice.exe',
+]
+
+
+class ErroConversao(Exception):
+    pass
+
+
+class FilaCheia(ErroConversao):
+    pass
+
+
+class TempoEsgotado(ErroConversao):
+    pass
+
+
+class Interrompida(ErroConversao):
+    pass
+
+
+def resolver_executavel():
+    """Procura o LibreOffice uma única vez (no PATH e, no Windows, nas pastas padrão)."""
+    for nome in ("libreoffice", "soffice"):
+        caminho = shutil.which(nome)
+        if caminho:
+            return caminho
+    if platform.system() == "Windows":
+        for p in _CAMINHOS_WINDOWS:
+            if os.path.exists(p):
+                return p
+    return "libreoffice"
+
+
+def _matar(proc):
+    try:
+        if platform.system() == "Windows":
+            subprocess.run(["taskkill", "/T", "/F", "/PID", str(proc.pid)], capture_output=True)
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        proc.kill()
+    proc.wait()
+
+
+class _Trabalhador(threading.Thread):
+    def __init__(self, servico, indice):
+        super().__init__(name=f"conversor-pdf-{indice}", daemon=True)
+        self.servico = servico
+        self.perfil = Path(servico.pasta_perfis) / f"perfil_{indice}"
+
+    def _executar(self, docx_path, output_dir, timeout, parar=None):
+        cmd = [
+            self.servico.executavel, f"-env:UserInstallation={self.perfil.as_uri()}",
+            "--headless", "--norestore", "--nologo", "--nodefault", "--nolockcheck",
+            "--convert-to", "pdf", "--outdir", str(output_dir), str(docx_path),
+        ]
+        extra = {} if platform.system() == "Windows" else {"start_new_session": True}
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **extra)
+        limite = time.monotonic() + timeout
+        while True:
+            try:
+                _, err = proc.communicate(timeout=min(INTERVALO_VERIFICACAO, max(limite - time.monotonic(), 0)))
+                break
+            except subprocess.TimeoutExpired:
+                if parar is not None and parar.is_set():
+                    _matar(proc)
+                    raise Interrompida("conversão interrompida")
+                if time.monotonic() >= limite:
+                    _matar(proc)
+                    raise TempoEsgotado(f"LibreOffice excedeu o tempo limite de {timeout}s")
+        pdf = Path(output_dir) / (Path(docx_path).stem + ".pdf")
+        if proc.returncode != 0 or not pdf.exists():
+            raise ErroConversao(err.decode(errors="replace").strip() or f"código de saída {proc.returncode}")
+        return str(pdf)
+
+    def _recriar_perfil(self):
+        shutil.rmtree(self.perfil, ignore_errors=True)
+
+    def aquecer(self):
+        """Cria o perfil com uma conversão de um documento vazio."""
+        from docx import Document
+        with tempfile.TemporaryDirectory() as tmp:
+            vazio = Path(tmp) / "aquecimento.docx"
+            Document().save(vazio)
+            try:
+                self._executar(vazio, tmp, TIMEOUT_CONVERSAO)
+            except Exception:
+                self._recriar_perfil()
+
+    def run(self):
+        self.aquecer()
+        while True:
+            tarefa = self.servico.fila.get()
+            if tarefa is None:
+                break
+            futuro, docx_path, output_dir, timeout, parar = tarefa
+            if not futuro.set_running_or_notify_cancel():
+                self.servico.fila.task_done()
+                continue
+            try:
+                try:
+                    futuro.set_result(self._executar(docx_path, output_dir, timeout, parar))
+                except (TempoEsgotado, Interrompida):
+                    # Morto a meio: o perfil pode ter ficado inconsistente
+                    self._recriar_perfil()
+                    raise
+                except ErroConversao:
+                    # LibreOffice caiu ou o perfil ficou corrompido: recomeça do zero uma vez
+                    self._recriar_perfil()
+                    futuro.set_result(self._executar(docx_path, output_dir, timeout, parar))
+            except Exception as e:
+                futuro.set_exception(e)
+            finally:
+                self.servico.fila.task_done()
+
+
+class ServicoConversao:
+    def __init__(self, max_conversoes=MAX_CONVERSOES, tamanho_fila=TAMANHO_FILA):
+        self.executavel = resolver_executavel()
+        self.pasta_perfis = tempfile.mkdtemp(prefix="lo_perfis_")
+        self.fila = queue.Queue(maxsize=tamanho_fila)
+        self._lock = threading.Lock()
+        self._trabalhadores = [_Trabalhador(self, i) for i in range(max_conversoes)]
+        for t in self._trabalhadores:
+            t.start()
+
+    def _supervisionar(self):
+        with self._lock:
+            for i, t in enumerate(self._trabalhadores):
+                if not t.is_alive():
+                    novo = _Trabalhador(self, i)
+                    novo.start()
+                    self._trabalhadores[i] = novo
+
+    def submeter(self, docx_path, output_dir, timeout=TIMEOUT_CONVERSAO, parar=None):
+        """Coloca a conversão na fila e devolve um ``Future`` com o caminho do PDF.
+
+        Se o ``threading.Event`` ``parar`` for ativado durante a conversão, o
+        LibreOffice é morto e o ``Future`` termina com ``Interrompida``.
+        """
+        self._supervisionar()
+        futuro = Future()
+        try:
+            self.fila.put((futuro, docx_path, output_dir, timeout, parar), block=False)
+        except queue.Full:
+            raise FilaCheia("Há demasiadas conversões em espera; tente novamente em instantes.")
+        return futuro
+
+    def encerrar(self):
+        for _ in self._trabalhadores:
+            try:
+                self.fila.put_nowait(None)
+            except queue.Full:
+                break
+        shutil.rmtree(self.pasta_perfis, ignore_errors=True)
+
+
+_servico = None
+_servico_lock = threading.Lock()
+
+
+def obter_servico():
+    global _servico
+    with _servico_lock:
+        if _servico is None:
+            _servico = ServicoConversao(MAX_CONVERSOES, TAMANHO_FILA)
+            atexit.register(_servico.encerrar)
+        return _servico
+
+
+def converter(docx_path, output_dir, timeout=TIMEOUT_CONVERSAO, verificar=None):
+    """Converte ``docx_path`` para PDF em ``output_dir`` e devolve o caminho do PDF.
+
+    ``verificar()``, se dado, é chamado periodicamente enquanto se espera; se
+    levantar uma exceção, a conversão é cancelada (ou o LibreOffice morto) e
+    a exceção propaga-se.
+    """
+    parar = threading.Event()
+    futuro = obter_servico().submeter(docx_path, output_dir, timeout, parar)
+    if verificar is None:
+        return futuro.result()
+    while True:
+        try:
+            return futuro.result(timeout=INTERVALO_VERIFICACAO)
+        except TempoDeEsperaEsgotado:
+            try:
+                verificar()
+            except BaseException:
+                parar.set()
+                futuro.cancel()
+                raise
@@ -0,0 +1,189 @@
+"""Medição por etapas (spans) da geração de relatórios.
+
+Uma ``Execucao`` ativa recolhe os spans abertos com ``span(...)`` em qualquer
+módulo do caminho de geração (marcador, evidência, página rasterizada,
+render/save/conversão), cada um com a duração, os bytes produzidos e a
+variação de memória. Sem uma execução ativa, ``span`` não faz nada, por isso
+os módulos podem ser instrumentados sem custo para quem não os mede.
+
+No fim, ``gravar_log`` acrescenta os spans como linhas JSON ao ficheiro
+``DIAGNOSTICO_LOG``. Com ``perfil=True`` a execução também corre sob
+``cProfile`` e ``tracemalloc`` e guarda as funções e alocações mais pesadas.
+O ``tracemalloc`` é global ao processo (conta também as alocações de quem
+corra ao mesmo tempo): fica ligado enquanto houver alguma execução com perfil
+aberta, e só essas medem a memória com ele — as outras usam sempre o RSS.
+Cada span indica a fonte em ``memoria_fonte``.
+"""
+import contextlib
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+DIAGNOSTICO_LOG = os.environ.get(
+    "DIAGNOSTICO_LOG", os.path.join(tempfile.gettempdir(), "diagnostico_novacidade.jsonl")
+)
+# Linhas do relatório de perfil (funções e alocações)
+TOP_PERFIL = 25
+
+_execucao_atual = contextvars.ContextVar("execucao_diagnostico", default=None)
+# Spans abertos no contexto atual (o último é o pai dos novos)
+_pilha = contextvars.ContextVar("pilha_diagnostico", default=())
+_log_lock = threading.Lock()
+# Execuções com perfil abertas; o tracemalloc só é parado pela última
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_usos = 0
+_tracemalloc_proprio = False
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource  # só existe em sistemas Unix
+    except ImportError:
+        return 0  # Windows: sem medição de memória, só tempos
+    # Fora do Linux fica o pico do processo, que só sobe
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico if sys.platform == "darwin" else pico * 1024
+
+
+def _ligar_tracemalloc():
+    global _tracemalloc_usos, _tracemalloc_proprio
+    with _tracemalloc_lock:
+        if _tracemalloc_usos == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            _tracemalloc_proprio = True
+        _tracemalloc_usos += 1
+
+
+def _desligar_tracemalloc():
+    global _tracemalloc_usos, _tracemalloc_proprio
+    with _tracemalloc_lock:
+        _tracemalloc_usos -= 1
+        # Ligado de fora (ex.: python -X tracemalloc) fica como estava
+        if _tracemalloc_usos == 0 and _tracemalloc_proprio:
+            tracemalloc.stop()
+            _tracemalloc_proprio = False
+
+
+class Execucao:
+    """Recolhe os spans de uma geração. Usar como ``with Execucao(...) as ex:``."""
+
+    def __init__(self, nome, perfil=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.nome = nome
+        self.perfil = perfil
+        self.spans = []
+        self.relatorio_perfil = ""
+        self._lock = threading.Lock()
+        self._inicio = None
+        self._tokens = []
+        self._profiler = None
+
+    def __enter__(self):
+        # Pode ser reaberta (ex.: geração e, depois, conversão): os spans acumulam
+        self._tokens.append(_execucao_atual.set(self))
+        if self._inicio is None:
+            self._inicio = time.perf_counter()
+        if self.perfil:
+            _ligar_tracemalloc()
+            if self._profiler is None:
+                self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self._profiler is not None:
+            self._profiler.disable()
+            self.relatorio_perfil = self._resumo_perfil()
+            _desligar_tracemalloc()
+        _execucao_atual.reset(self._tokens.pop())
+        return False
+
+    def _memoria(self):
+        """``(fonte, bytes)`` da memória usada agora: tracemalloc nas execuções com perfil, senão RSS."""
+        if self.perfil and tracemalloc.is_tracing():
+            return "tracemalloc", tracemalloc.get_traced_memory()[0]
+        return "rss", _rss_bytes()
+
+    def _resumo_perfil(self):
+        saida = io.StringIO()
+        pstats.Stats(self._profiler, stream=saida).sort_stats("cumulative").print_stats(TOP_PERFIL)
+        if tracemalloc.is_tracing():
+            atual, pico = tracemalloc.get_traced_memory()
+            saida.write(f"\ntracemalloc: atual {atual / 1024 / 1024:.1f} MB, pico {pico / 1024 / 1024:.1f} MB\n")
+            for estat in tracemalloc.take_snapshot().statistics("lineno")[:TOP_PERFIL]:
+                saida.write(f"{estat}\n")
+        return saida.getvalue()
+
+    @contextlib.contextmanager
+    def span(self, nome, **atributos):
+        pilha = _pilha.get()
+        registo = {"nome": nome, "pai": pilha[-1]["id"] if pilha else None, "nivel": len(pilha),
+                   "id": uuid.uuid4().hex[:8], **atributos}
+        token = _pilha.set(pilha + (registo,))
+        fonte, mem_antes = self._memoria()
+        inicio = time.perf_counter()
+        try:
+            yield registo
+        except BaseException as e:
+            registo["erro"] = repr(e)
+            raise
+        finally:
+            registo["inicio"] = inicio - self._inicio
+            registo["segundos"] = time.perf_counter() - inicio
+            registo["memoria_fonte"] = fonte
+            registo["memoria_delta"] = self._memoria()[1] - mem_antes
+            _pilha.reset(token)
+            with self._lock:
+                self.spans.append(registo)
+
+    def registar(self, nome, segundos, **atributos):
+        """Span medido noutro lado (ex.: página rasterizada num processo do pool)."""
+        pilha = _pilha.get()
+        registo = {"nome": nome, "pai": pilha[-1]["id"] if pilha else None, "nivel": len(pilha),
+                   "id": uuid.uuid4().hex[:8], "inicio": time.perf_counter() - self._inicio - segundos,
+                   "segundos": segundos, **atributos}
+        with self._lock:
+            self.spans.append(registo)
+
+    def tabela(self):
+        """Spans por ordem de início, prontos para um ``DataFrame``."""
+        return sorted(self.spans, key=lambda s: s["inicio"])
+
+    def gravar_log(self, caminho=DIAGNOSTICO_LOG):
+        """Acrescenta os spans a ``caminho``, uma linha JSON por span."""
+        data = time.strftime("%Y-%m-%dT%H:%M:%S")
+        linhas = [json.dumps({"execucao": self.id, "relatorio": self.nome, "data": data, **s},
+                             ensure_ascii=False, default=str) for s in self.tabela()]
+        with _log_lock, open(caminho, "a", encoding="utf-8") as f:
+            f.write("\n".join(linhas) + "\n")
+
+
+@contextlib.contextmanager
+def span(nome, **atributos):
+    """Abre um span na execução ativa; sem execução, devolve um dicionário descartável."""
+    execucao = _execucao_atual.get()
+    if execucao is None:
+        yield {}
+        return
+    with execucao.span(nome, **atributos) as registo:
+        yield registo
+
+
+def registar(nome, segundos, **atributos):
+    execucao = _execucao_atual.get()
+    if execucao is not None:
+        execucao.registar(nome, segundos, **atributos)
@@ -0,0 +1,247 @@
+"""Geração de relatórios em segundo plano, com progresso, cancelamento e memoização.
+
+O botão da interface só submete um ``Trabalho``; a geração corre num pool
+limitado de threads (``MAX_GERACOES``), partilhado por todas as sessões, e
+sobrevive a reruns e ao fecho do separador. O LibreOffice e a rasterização dos
+PDFs longos (``MIN_PAGINAS_PARALELO`` páginas ou mais) correm noutros
+processos. Os PDFs curtos e a inserção das páginas em vetor usam o PyMuPDF
+nestas threads, uma de cada vez (``rasterizacao_pdf.FITZ_LOCK``): várias
+gerações ao mesmo tempo repartem esse trabalho, não o fazem em paralelo.
+
+Cada trabalho é identificado por uma chave calculada a partir do estado do
+formulário, dos hashes das evidências, do hash do template e dos parâmetros
+de renderização. Os DOCX/PDF concluídos ficam em ``RESULTADOS_DIR/<chave>``:
+voltar a pedir o mesmo relatório devolve logo os ficheiros já gerados, e um
+pedido igual a um que ainda está a correr junta-se a ele. As pastas de
+trabalhos ainda consultáveis nunca são podadas.
+
+Cancelar é verificado antes de cada evidência, de cada página rasterizada e,
+durante a conversão para PDF, a cada ``conversor_pdf.INTERVALO_VERIFICACAO``
+segundos (o LibreOffice é morto). O render e a gravação do DOCX não são
+interrompidos a meio.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cache_template
+import diagnostico
+import motor_relatorio
+
+MAX_GERACOES = int(os.environ.get("RELATORIOS_MAX_GERACOES", 2))
+# Trabalhos à espera além dos que estão a correr
+TAMANHO_FILA = int(os.environ.get("RELATORIOS_TAMANHO_FILA", 8))
+RESULTADOS_DIR = Path(os.environ.get(
+    "RELATORIOS_RESULTADOS_DIR", os.path.join(tempfile.gettempdir(), "relatorios_gerados_novacidade")
+))
+MAX_RESULTADOS = int(os.environ.get("RELATORIOS_MAX_RESULTADOS", 50))
+# Trabalhos terminados ficam consultáveis durante este tempo
+RETENCAO_SEGUNDOS = 3600
+
+NA_FILA, A_GERAR, CONCLUIDO, ERRO, CANCELADO = "na_fila", "a_gerar", "concluido", "erro", "cancelado"
+
+
+class FilaCheia(RuntimeError):
+    pass
+
+
+class Cancelado(BaseException):
+    # BaseException, como o CancelledError do asyncio: atravessa os ``except
+    # Exception`` do motor (evidência ilegível, PDF vetorial indisponível...)
+    pass
+
+
+def chave_trabalho(form_state, evidencias, template, pdf):
+    """Hash de tudo o que determina o resultado da geração."""
+    partes = {
+        "form_state": form_state,
+        "evidencias": {m: [(i["name"], i["type"], i["sha256"]) for i in itens] for m, itens in evidencias.items() if itens},
+        "template": cache_template.CACHE.sha256(template),
+        "variante": motor_relatorio.VARIANTE_RENDER,
+        "pdf": pdf,
+        "pdf_vetorial": motor_relatorio.PDF_VETORIAL,
+    }
+    return hashlib.sha256(json.dumps(partes, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class Trabalho:
+    def __init__(self, chave, form_state, evidencias, template, pdf, perfil=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.chave = chave
+        self.form_state = form_state
+        # Cópia das listas: a sessão pode mudar enquanto o trabalho corre
+        self.evidencias = {m: list(itens) for m, itens in evidencias.items()}
+        self.template = template
+        self.pdf = pdf
+        self.estado = NA_FILA
+        self.etapa = ""
+        self.marcadores = (0, len(motor_relatorio.DIMENSOES_CAMPOS))
+        self.resultado = None
+        self.erro = None
+        self.memoizado = False
+        self.estatisticas = {}
+        self.execucao = diagnostico.Execucao(f"{form_state.get('sel_mes')}/{form_state.get('sel_ano')}", perfil=perfil)
+        self.terminado_em = None
+        # Pasta dos ficheiros do trabalho (temporária enquanto corre)
+        self.pasta = None
+        self._cancelar = threading.Event()
+
+    @property
+    def terminado(self):
+        return self.estado in (CONCLUIDO, ERRO, CANCELADO)
+
+    @property
+    def paginas(self):
+        return sum(1 for s in list(self.execucao.spans) if s["nome"] == "pagina")
+
+    def cancelar(self):
+        self._cancelar.set()
+
+    def _progresso(self, etapa, feitos=0, total=0):
+        if self._cancelar.is_set():
+            raise Cancelado()
+        if etapa == "pagina":
+            return  # só um ponto de cancelamento; a etapa mostrada continua a do marcador
+        self.etapa = etapa
+        if etapa == "marcadores":
+            self.marcadores = (feitos, total)
+
+    def _terminar(self, estado):
+        self.estado = estado
+        self.terminado_em = time.time()
+
+
+def _resultado_guardado(chave, pdf):
+    pasta = RESULTADOS_DIR / chave
+    docx_p, pdf_p = pasta / "relatorio.docx", pasta / "relatorio.pdf"
+    if not docx_p.exists() or (pdf and not pdf_p.exists()):
+        return None
+    os.utime(pasta)
+    return {"docx": str(docx_p), "pdf": str(pdf_p) if pdf else None}
+
+
+def _podar_resultados(em_uso=()):
+    """Apaga resultados antigos, exceto as pastas (nomes) em ``em_uso``."""
+    limite = time.time() - RETENCAO_SEGUNDOS
+    pastas = []
+    memoizados = 0
+    for p in RESULTADOS_DIR.iterdir():
+        if not p.is_dir():
+            continue
+        temporaria = p.name.startswith(".tmp_")
+        memoizados += not temporaria
+        if p.name in em_uso:
+            continue
+        if temporaria:
+            # Resultados não memoizados (ex.: sem PDF) só vivem enquanto o trabalho é consultável
+            if p.stat().st_mtime < limite:
+                shutil.rmtree(p, ignore_errors=True)
+        else:
+            pastas.append(p)
+    pastas.sort(key=lambda p: p.stat().st_mtime)
+    for p in pastas[:max(0, memoizados - MAX_RESULTADOS)]:
+        shutil.rmtree(p, ignore_errors=True)
+
+
+class ServicoGeracao:
+    def __init__(self, max_geracoes=MAX_GERACOES, tamanho_fila=TAMANHO_FILA):
+        RESULTADOS_DIR.mkdir(parents=True, exist_ok=True)
+        self.limite = max_geracoes + tamanho_fila
+        self._pool = ThreadPoolExecutor(max_workers=max_geracoes, thread_name_prefix="geracao")
+        self._trabalhos = {}
+        self._lock = threading.Lock()
+
+    def _limpar_antigos(self):
+        limite = time.time() - RETENCAO_SEGUNDOS
+        for tid in [t.id for t in self._trabalhos.values() if t.terminado and t.terminado_em < limite]:
+            del self._trabalhos[tid]
+
+    def submeter(self, form_state, evidencias, pdf=True, template=motor_relatorio.TEMPLATE_PADRAO, perfil=False):
+        """Devolve o ``Trabalho`` do pedido: já concluído (memoizado), em curso ou novo."""
+        chave = chave_trabalho(form_state, evidencias, template, pdf)
+        with self._lock:
+            self._limpar_antigos()
+            for t in self._trabalhos.values():
+                if t.chave == chave and not t.terminado:
+                    return t
+            trabalho = Trabalho(chave, form_state, evidencias, template, pdf, perfil)
+            guardado = _resultado_guardado(chave, pdf)
+            if guardado is not None:
+                trabalho.resultado, trabalho.memoizado = guardado, True
+                trabalho.pasta = os.path.dirname(guardado["docx"])
+                trabalho.marcadores = (trabalho.marcadores[1],) * 2
+                trabalho._terminar(CONCLUIDO)
+            else:
+                if sum(1 for t in self._trabalhos.values() if not t.terminado) >= self.limite:
+                    raise FilaCheia("Há demasiados relatórios em geração; tente novamente em instantes.")
+                self._pool.submit(self._executar, trabalho)
+            self._trabalhos[trabalho.id] = trabalho
+        return trabalho
+
+    def obter(self, trabalho_id):
+        with self._lock:
+            return self._trabalhos.get(trabalho_id)
+
+    def _pastas_em_uso(self):
+        with self._lock:
+            return {os.path.basename(t.pasta) for t in self._trabalhos.values() if t.pasta}
+
+    def _executar(self, trabalho):
+        if trabalho._cancelar.is_set():
+            trabalho._terminar(CANCELADO)
+            return
+        trabalho.estado = A_GERAR
+        tmp = trabalho.pasta = tempfile.mkdtemp(prefix=".tmp_", dir=RESULTADOS_DIR)
+        try:
+            with trabalho.execucao:
+                res = motor_relatorio.gerar_relatorio(
+                    trabalho.form_state, trabalho.evidencias, tmp, pdf=trabalho.pdf, template=trabalho.template,
+                    estatisticas=trabalho.estatisticas, progresso=trabalho._progresso,
+                )
+            if trabalho._cancelar.is_set():
+                raise Cancelado()
+            if res["pdf"] or not trabalho.pdf:
+                # Só resultados completos são memoizados; sem PDF, tenta-se de novo no próximo pedido
+                destino = RESULTADOS_DIR / trabalho.chave
+                shutil.rmtree(destino, ignore_errors=True)
+                os.replace(tmp, destino)
+                tmp = trabalho.pasta = str(destino)
+            _podar_resultados(self._pastas_em_uso())
+            trabalho.resultado = {
+                "docx": os.path.join(tmp, "relatorio.docx"),
+                "pdf": os.path.join(tmp, "relatorio.pdf") if res["pdf"] else None,
+                "erro_pdf": res.get("erro_pdf"),
+                "aviso_pdf": res.get("aviso_pdf"),
+            }
+            trabalho._terminar(CONCLUIDO)
+        except Cancelado:
+            shutil.rmtree(tmp, ignore_errors=True)
+            trabalho.pasta = None
+            trabalho._terminar(CANCELADO)
+        except Exception as e:
+            shutil.rmtree(tmp, ignore_errors=True)
+            trabalho.pasta = None
+            trabalho.erro = str(e)
+            trabalho._terminar(ERRO)
+        finally:
+            if trabalho.execucao.spans:
+                trabalho.execucao.gravar_log()
+
+
+_servico = None
+_servico_lock = threading.Lock()
+
+
+def obter_servico():
+    global _servico
+    with _servico_lock:
+        if _servico is None:
+            _servico = ServicoGeracao(MAX_GERACOES, TAMANHO_FILA)
+        return _servico
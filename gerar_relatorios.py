@@ -0,0 +1,138 @@
+"""Geração de relatórios em lote, sem a interface.
+
+Exemplos::
+
+    # todos os relatórios salvos, DOCX e PDF, 4 processos
+    python gerar_relatorios.py relatorios_salvos_novacidade --saida saida/ --processos 4
+
+    # backups exportados, apenas DOCX
+    python gerar_relatorios.py Backup_*.zip --formato docx
+
+Cada origem pode ser uma pasta com ``estado.json``, uma pasta que contém
+várias dessas pastas, ou um backup ``.zip`` (restaurado e validado como na
+interface, ver ``restauro_backup``). No fim é mostrado um resumo por relatório,
+com as evidências que não foi possível restaurar, e o código de saída é 1 se
+algum falhar.
+
+Os ficheiros gerados têm o nome da origem; se duas origens tiverem o mesmo
+nome (ex.: ``2026/Backup_Relatorio_maio.zip`` e ``2027/Backup_Relatorio_maio.zip``),
+leva também o da pasta que as contém (``2026_Backup_Relatorio_maio``) e, se
+ainda assim coincidirem, um sufixo numérico.
+"""
+import argparse
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+
+def _expandir_origens(origens):
+    encontradas = []
+    for o in map(Path, origens):
+        if o.is_dir() and not (o / "estado.json").exists():
+            encontradas.extend(sorted(p for p in o.iterdir() if (p / "estado.json").exists()))
+        else:
+            encontradas.append(o)
+    return encontradas
+
+
+def _nome_origem(origem):
+    return origem.stem if origem.suffix.lower() == ".zip" else origem.name
+
+
+def _nomes_saida(origens):
+    """Nome base (único) dos ficheiros gerados para cada origem."""
+    contagem = {}
+    for o in origens:
+        contagem[_nome_origem(o)] = contagem.get(_nome_origem(o), 0) + 1
+    nomes = {}
+    usados = set()
+    for o in origens:
+        nome = _nome_origem(o)
+        if contagem[nome] > 1:
+            nome = f"{o.resolve().parent.name}_{nome}"
+        candidato, n = nome, 2
+        while candidato.lower() in usados:
+            candidato, n = f"{nome}_{n}", n + 1
+        usados.add(candidato.lower())
+        nomes[o] = candidato
+    return nomes
+
+
+def _inicializar_processo():
+    # Já há paralelismo entre relatórios: cada processo rasteriza e converte sozinho
+    import conversor_pdf
+    import rasterizacao_pdf
+    rasterizacao_pdf.MAX_PROCESSOS = 1
+    conversor_pdf.MAX_CONVERSOES = 1
+
+
+def _gerar_um(origem, pasta_saida, nome_base, formato, template, vetorial):
+    import motor_relatorio
+    inicio = time.perf_counter()
+    form_state, evidencias, falhas = motor_relatorio.ler_origem(origem)
+    resultado = motor_relatorio.gerar_relatorio(
+        form_state, evidencias, pasta_saida, nome_base=nome_base,
+        pdf=formato in ("pdf", "ambos"), template=template or motor_relatorio.TEMPLATE_PADRAO,
+        vetorial=vetorial, docx=formato != "pdf",
+    )
+    resultado["falhas_restauro"] = falhas
+    resultado["segundos"] = time.perf_counter() - inicio
+    return resultado
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gera relatórios UPA Nova Cidade em lote.")
+    parser.add_argument("origens", nargs="+", help="pastas salvas, pasta base ou backups .zip")
+    parser.add_argument("--saida", default="relatorios_gerados", help="pasta de destino (padrão: %(default)s)")
+    parser.add_argument("--formato", choices=["docx", "pdf", "ambos"], default="ambos")
+    parser.add_argument("--processos", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--template", default=None, help="template .docx alternativo")
+    parser.add_argument("--pdf-raster", action="store_true",
+                        help="no PDF, usar as páginas rasterizadas dos PDFs de evidência em vez das originais em vetor")
+    args = parser.parse_args(argv)
+
+    origens = _expandir_origens(args.origens)
+    if not origens:
+        print("Nenhum relatório encontrado.", file=sys.stderr)
+        return 1
+    pasta_saida = Path(args.saida)
+    pasta_saida.mkdir(parents=True, exist_ok=True)
+    nomes = _nomes_saida(origens)
+    if len(set(n.lower() for n in nomes.values())) != len(origens):
+        # Sistemas de ficheiros sem distinção de maiúsculas
+        print("Há origens cujos ficheiros de saída coincidiriam; renomeie-as.", file=sys.stderr)
+        return 1
+
+    falhas = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.processos), initializer=_inicializar_processo) as pool:
+        futuros = {
+            pool.submit(_gerar_um, str(o), str(pasta_saida), nomes[o], args.formato, args.template, not args.pdf_raster): o
+            for o in origens
+        }
+        for fut in as_completed(futuros):
+            origem = futuros[fut]
+            try:
+                res = fut.result()
+            except Exception:
+                falhas += 1
+                erro = traceback.format_exc(limit=1).strip().splitlines()[-1]
+                print(f"[FALHA] {origem}: {erro}")
+                continue
+            if args.formato != "docx" and not res["pdf"]:
+                falhas += 1
+                print(f"[FALHA] {origem}: PDF não gerado ({res.get('erro_pdf', 'sem detalhe')})")
+                continue
+            saidas = ", ".join(Path(p).name for p in (res["docx"], res["pdf"]) if p)
+            print(f"[OK]    {origem} -> {saidas} ({res['segundos']:.1f}s)")
+            for f in res["falhas_restauro"]:
+                print(f"        evidência não restaurada: {f['nome']} ({f['marcador']}): {f['motivo']}")
+
+    print(f"\n{len(origens) - falhas} de {len(origens)} relatórios gerados em {pasta_saida}/")
+    return 1 if falhas else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""Gráficos dos marcadores ``GRAFICO_*`` gerados a partir dos dados do formulário.
+
+Em vez de prints colados à mão, os gráficos de transferências e de ouvidoria
+(e o de atendimentos face à meta, mostrado na interface) são desenhados no servidor com o backend Agg do matplotlib (sem pyplot, que
+não é seguro entre threads), a partir da série mensal: os relatórios do
+catálogo mais o mês que está a ser preenchido. A série é montada com pandas
+sobre todos os meses de uma vez (conversão, deduplicação por período, metas e
+taxas) e cada gráfico vai para o ``cache_render`` com uma chave calculada a
+partir dos dados que desenha — reruns e pedidos iguais não voltam a desenhar.
+"""
+import io
+import json
+import os
+
+import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+import cache_render
+import normalizacao_imagens
+from motor_relatorio import DIMENSOES_CAMPOS, FORM_KEYS, MESES_PT, META_DIARIA_CONTRATO
+
+# Incrementar quando o desenho dos gráficos mudar, para invalidar o cache
+VERSAO_GRAFICOS = "2"
+
+# Meses mostrados, terminando no mês do relatório
+MESES_HISTORICO = int(os.environ.get("GRAFICOS_MESES", 12))
+DPI_GRAFICOS = normalizacao_imagens.DPI_IMAGENS
+PROPORCAO = 0.5  # altura / largura
+# Largura (mm) dos gráficos que não vão para um marcador do template
+LARGURA_PADRAO_MM = 160
+
+NOMES = {
+    "GRAFICO_TRANSFERENCIA": "Grafico_Transferencias.png",
+    "GRAFICO_OUVIDORIA": "Grafico_Ouvidoria.png",
+}
+
+COR_BARRAS = "#2f6fb0"
+COR_ATUAL = "#28a745"
+COR_LINHA = "#dc3545"
+
+_COLUNAS = {
+    "in_total": "atendimentos", "in_tt": "transferencias", "in_taxa": "taxa",
+    "in_oi": "ouvidoria_interna", "in_oe": "ouvidoria_externa",
+}
+
+
+def _numeros(serie, decimal=False):
+    """Converte uma coluna do formulário (texto ou número) em float; vazio -> NaN."""
+    texto = serie.map(lambda v: isinstance(v, str))
+    limpo = serie.where(texto, "").astype(str).str.strip().str.replace("%", "", regex=False)
+    if decimal:
+        limpo = limpo.str.replace(",", ".", regex=False)
+    else:
+        # Nos campos inteiros o ponto é separador de milhares ("1.234")
+        limpo = limpo.str.replace(".", "", regex=False).str.replace(",", "", regex=False)
+    return pd.to_numeric(limpo, errors="coerce").where(texto, pd.to_numeric(serie.where(~texto), errors="coerce"))
+
+
+def historico(relatorios, form_state=None):
+    """Série mensal para os gráficos, ordenada por período.
+
+    ``relatorios`` são as linhas do catálogo (``Catalogo.listar``); de vários
+    relatórios salvos do mesmo período fica o gravado por último. O
+    ``form_state`` atual, se dado, entra como o mês mais recente e prevalece
+    sobre um relatório salvo do mesmo período. Ficam os ``MESES_HISTORICO``
+    meses que terminam no mês de ``form_state`` (ou no último salvo).
+    """
+    # O catálogo vem ordenado por período e nome: a ordem de gravação decide entre versões do mesmo mês
+    salvos = sorted((r for r in relatorios if r.get("form_state")), key=lambda r: r.get("manifesto_mtime_ns") or 0)
+    estados = [json.loads(r["form_state"]) for r in salvos]
+    if form_state is not None:
+        estados.append({k: form_state.get(k) for k in FORM_KEYS})
+    df = pd.DataFrame(estados, columns=FORM_KEYS)
+    if df.empty:
+        return pd.DataFrame(columns=["ano", "mes_num", "periodo", "meta", *_COLUNAS.values()])
+
+    df["mes_num"] = df["sel_mes"].map({m: i + 1 for i, m in enumerate(MESES_PT)})
+    df["ano"] = pd.to_numeric(df["sel_ano"], errors="coerce")
+    # Ordem de chegada: o formulário atual vem por último e ganha ao salvo do mesmo mês
+    df = df.dropna(subset=["mes_num", "ano"]).drop_duplicates(["ano", "mes_num"], keep="last")
+    df = df.astype({"ano": int, "mes_num": int}).sort_values(["ano", "mes_num"])
+
+    serie = pd.DataFrame({"ano": df["ano"], "mes_num": df["mes_num"]})
+    for chave, coluna in _COLUNAS.items():
+        serie[coluna] = _numeros(df[chave], decimal=chave == "in_taxa")
+    inicio_mes = pd.to_datetime(pd.DataFrame({"year": serie["ano"], "month": serie["mes_num"], "day": 1}))
+    serie["meta"] = inicio_mes.dt.days_in_month * META_DIARIA_CONTRATO
+    # Taxa em falta: calculada a partir das transferências e do total de atendimentos
+    calculada = serie["transferencias"] / serie["atendimentos"].where(serie["atendimentos"] > 0) * 100
+    serie["taxa"] = serie["taxa"].fillna(calculada.round(2))
+    abreviaturas = {i + 1: m[:3] for i, m in enumerate(MESES_PT)}
+    serie["periodo"] = serie["mes_num"].map(abreviaturas) + "/" + (serie["ano"] % 100).astype(str).str.zfill(2)
+
+    if form_state is not None and form_state.get("sel_mes") in MESES_PT and form_state.get("sel_ano"):
+        # Meses posteriores ao do relatório não entram
+        ultimo = int(form_state["sel_ano"]) * 12 + MESES_PT.index(form_state["sel_mes"]) + 1
+        serie = serie[serie["ano"] * 12 + serie["mes_num"] <= ultimo]
+    return serie.tail(MESES_HISTORICO).reset_index(drop=True)
+
+
+def _figura(largura_mm):
+    largura_pol = largura_mm / 25.4
+    fig = Figure(figsize=(largura_pol, largura_pol * PROPORCAO), dpi=DPI_GRAFICOS)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _cores(n):
+    return [COR_BARRAS] * (n - 1) + [COR_ATUAL]
+
+
+def _desenhar_transferencia(ax, dados):
+    x = range(len(dados))
+    barras = ax.bar(x, dados["transferencias"].fillna(0), color=_cores(len(dados)))
+    ax.bar_label(barras, fmt="%.0f", fontsize=7)
+    ax.set_ylabel("Transferências", fontsize=8)
+    # Folga no topo para os rótulos das barras não tocarem na linha da taxa
+    ax.set_ylim(0, max(dados["transferencias"].max(), 1) * 1.35)
+    maximo_taxa = dados["taxa"].max()
+    # Sem taxa nem total de atendimentos em nenhum mês, fica só o gráfico de barras
+    if pd.notna(maximo_taxa):
+        taxa = ax.twinx()
+        taxa.plot(x, dados["taxa"], color=COR_LINHA, marker="o", markersize=3, linewidth=1.2)
+        taxa.set_ylabel("Taxa (%)", color=COR_LINHA, fontsize=8)
+        taxa.set_ylim(0, max(maximo_taxa, 0.01) * 1.15)
+        taxa.tick_params(axis="y", colors=COR_LINHA, labelsize=7)
+    ax.set_title("Transferências e taxa de transferência por mês", fontsize=9)
+
+
+def _desenhar_ouvidoria(ax, dados):
+    x = range(len(dados))
+    interna = dados["ouvidoria_interna"].fillna(0)
+    externa = dados["ouvidoria_externa"].fillna(0)
+    ax.bar(x, interna, color=COR_BARRAS, label="Interna")
+    barras = ax.bar(x, externa, bottom=interna, color="#f0ad4e", label="Externa")
+    ax.bar_label(barras, labels=[f"{v:.0f}" for v in interna + externa], fontsize=7)
+    ax.set_ylabel("Manifestações", fontsize=8)
+    ax.legend(fontsize=7, loc="upper left")
+    ax.set_title("Ouvidoria interna e externa por mês", fontsize=9)
+
+
+def _desenhar_atendimentos(ax, dados):
+    x = range(len(dados))
+    barras = ax.bar(x, dados["atendimentos"].fillna(0), color=_cores(len(dados)), label="Atendimentos")
+    ax.bar_label(barras, fmt="%.0f", fontsize=6)
+    ax.plot(x, dados["meta"], color=COR_LINHA, linewidth=1.2, label="Meta")
+    ax.fill_between(x, dados["meta"] * 0.75, dados["meta"] * 1.25, color=COR_LINHA, alpha=0.1, label="Meta ±25%")
+    ax.set_ylabel("Atendimentos", fontsize=8)
+    ax.set_ylim(0, max(dados["atendimentos"].max(), dados["meta"].max() * 1.25) * 1.25)
+    ax.legend(fontsize=7, loc="upper center", ncol=3, frameon=False)
+    ax.set_title("Atendimentos face à meta do contrato por mês", fontsize=9)
+
+
+# marcador -> (função de desenho, colunas desenhadas, colunas que têm de ter algum valor)
+_DESENHOS = {
+    "GRAFICO_TRANSFERENCIA": (_desenhar_transferencia, ["transferencias", "taxa"], ["transferencias", "taxa"]),
+    "GRAFICO_OUVIDORIA": (_desenhar_ouvidoria, ["ouvidoria_interna", "ouvidoria_externa"],
+                          ["ouvidoria_interna", "ouvidoria_externa"]),
+    # A meta existe sempre (vem do calendário): sem atendimentos não há gráfico
+    "ATENDIMENTOS_META": (_desenhar_atendimentos, ["atendimentos", "meta"], ["atendimentos"]),
+}
+# Os que vão para marcadores do template
+GRAFICOS = [m for m in _DESENHOS if m in DIMENSOES_CAMPOS]
+
+
+def _desenhar(marcador, dados, largura_mm):
+    desenhar = _DESENHOS[marcador][0]
+    fig = _figura(largura_mm)
+    ax = fig.subplots()
+    desenhar(ax, dados)
+    ax.set_xticks(range(len(dados)), dados["periodo"], fontsize=7)
+    ax.tick_params(axis="y", labelsize=7)
+    ax.spines[["top"]].set_visible(False)
+    fig.tight_layout()
+    buf = io.BytesIO()
+    # Sem metadados (versão do matplotlib), para o mesmo gráfico dar os mesmos bytes
+    fig.savefig(buf, format="png", metadata={"Software": None})
+    return buf.getvalue()
+
+
+def gerar_grafico(marcador, dados):
+    """PNG do gráfico ``marcador`` para a série ``dados`` (ver ``historico``), ou ``None`` sem dados."""
+    _, colunas, obrigatorias = _DESENHOS[marcador]
+    usados = dados[["periodo", *colunas]]
+    if usados[obrigatorias].isna().all().all():
+        return None
+    largura = DIMENSOES_CAMPOS.get(marcador, LARGURA_PADRAO_MM)
+    assinatura = usados.to_json(orient="split", double_precision=6)
+    chave = cache_render.chave_render(
+        cache_render.hash_bytes(assinatura.encode("utf-8")), marcador, largura,
+        f"graficos={VERSAO_GRAFICOS}|dpi={DPI_GRAFICOS}",
+    )
+    imagens, _ = cache_render.CACHE.obter_ou_renderizar(chave, lambda: ([_desenhar(marcador, usados, largura)], {}))
+    return imagens[0]
@@ -0,0 +1,86 @@
+"""Miniaturas das evidências para as pré-visualizações da interface.
+
+Cada evidência do armazém dá origem, uma única vez, a uma miniatura pequena
+(``LARGURA_PX`` de largura) identificada pelo sha256 do conteúdo; os PDFs
+mostram a primeira página e guardam também o número de páginas. As miniaturas
+vivem numa ``CacheRender`` própria (LRU em memória e em disco, com limites em
+bytes), por isso um rerun não volta a descodificar a imagem original nem a
+enviar megabytes para o browser.
+"""
+import io
+import os
+import tempfile
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageOps
+
+import armazem_evidencias
+import cache_render
+import normalizacao_imagens
+import rasterizacao_pdf
+
+# Incrementar quando a forma de gerar as miniaturas mudar
+VERSAO_MINIATURAS = "1"
+
+LARGURA_PX = int(os.environ.get("MINIATURAS_LARGURA_PX", 480))
+# Páginas muito compridas (ex.: prints com scroll) são reduzidas até caberem nesta altura
+ALTURA_MAX_PX = LARGURA_PX * 3
+MINIATURAS_DIR = os.environ.get(
+    "MINIATURAS_DIR", os.path.join(tempfile.gettempdir(), "miniaturas_novacidade")
+)
+
+CACHE = cache_render.CacheRender(
+    pasta=MINIATURAS_DIR,
+    limite_memoria=int(os.environ.get("MINIATURAS_MEMORIA_MB", 32)) * 1024 * 1024,
+    limite_disco=int(os.environ.get("MINIATURAS_DISCO_MB", 256)) * 1024 * 1024,
+)
+
+
+def _reduzir(img):
+    img = ImageOps.exif_transpose(img)
+    img.thumbnail((LARGURA_PX, ALTURA_MAX_PX), Image.LANCZOS)
+    return normalizacao_imagens.codificar(img)
+
+
+def _miniatura_imagem(sha):
+    with armazem_evidencias.ARMAZEM.abrir(sha) as mm:
+        img = Image.open(mm)
+        largura, altura = img.size
+        # JPEGs grandes: descodifica já a uma escala reduzida
+        img.draft("RGB", (LARGURA_PX, LARGURA_PX))
+        img.load()
+    return [_reduzir(img)], {"largura": largura, "altura": altura}
+
+
+def _miniatura_pdf(sha):
+    with rasterizacao_pdf.FITZ_LOCK, rasterizacao_pdf.abrir_pdf(armazem_evidencias.ARMAZEM.caminho(sha)) as pdf:
+        paginas = pdf.page_count
+        if paginas == 0:
+            return [], {"paginas": 0}
+        pagina = pdf[0]
+        zoom = LARGURA_PX / pagina.rect.width
+        pix = pagina.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        img = Image.open(io.BytesIO(pix.tobytes("png")))
+    return [_reduzir(img)], {"paginas": paginas}
+
+
+def miniatura(item):
+    """Devolve ``(png, meta)`` da evidência ``item`` (handle do armazém).
+
+    ``png`` é ``None`` para tipos sem miniatura (planilhas) ou conteúdo
+    ilegível; ``meta`` traz ``paginas`` nos PDFs e as dimensões originais nas
+    imagens.
+    """
+    nome = item["name"].lower()
+    if item["type"] == "p" or nome.endswith((".png", ".jpg", ".jpeg")):
+        gerar = _miniatura_imagem
+    elif nome.endswith(".pdf"):
+        gerar = _miniatura_pdf
+    else:
+        return None, {}
+    chave = cache_render.chave_render(item["sha256"], "miniatura", LARGURA_PX, VERSAO_MINIATURAS)
+    try:
+        imagens, meta = CACHE.obter_ou_renderizar(chave, lambda: gerar(item["sha256"]))
+    except Exception as e:
+        return None, {"erro": str(e)}
+    return (imagens[0] if imagens else None), meta
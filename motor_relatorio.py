@@ -0,0 +1,469 @@
+"""Motor de geração do relatório, independente do Streamlit.
+
+Recebe o estado do formulário (o ``form_state`` do ``estado.json``) e as
+evidências por marcador e produz o DOCX e, opcionalmente, o PDF. É usado
+pela interface (``app.py``) e pela geração em lote (``gerar_relatorios.py``).
+"""
+import calendar
+import contextvars
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from pathlib import Path
+
+from docx.shared import Mm
+from docxtpl import InlineImage
+from PIL import Image
+
+import armazem_evidencias
+import armazenamento
+import cache_render
+import cache_template
+import conversor_pdf
+import diagnostico
+import normalizacao_imagens
+import pdf_vetorial
+import rasterizacao_pdf
+import tabela_excel
+
+# --- CONSTANTES DO CONTRATO ---
+META_DIARIA_CONTRATO = 250
+
+TEMPLATE_PADRAO = Path(__file__).resolve().parent / "template-upa-nova-cidade.docx"
+
+MESES_PT = ["janeiro", "fevereiro", "março", "abril", "maio", "junho", "julho", "agosto", "setembro", "outubro", "novembro", "dezembro"]
+
+# --- DICIONÁRIO DE DIMENSÕES ---
+DIMENSOES_CAMPOS = {
+    "IMAGEM_PRINT_ATENDIMENTO": 165, "PRINT_CLASSIFICACAO": 160,
+    "IMAGEM_DOCUMENTO_RAIO_X": 150, "TABELA_TRANSFERENCIA": 90,
+    "GRAFICO_TRANSFERENCIA": 150, "TABELA_OBITO": 180,
+    "TABELA_CCIH": 175, "IMAGEM_NEP": 160,
+    "IMAGEM_TREINAMENTO_INTERNO": 160, "IMAGEM_MELHORIAS": 160,
+    "GRAFICO_OUVIDORIA": 155, "PDF_OUVIDORIA_INTERNA": 165,
+    "TABELA_QUALITATIVA_IMG": 190
+}
+
+# DPI alvo das páginas de PDF rasterizadas (a largura vem de DIMENSOES_CAMPOS)
+RASTER_DPI = rasterizacao_pdf.DPI_PADRAO
+# Parâmetros que mudam o resultado da renderização entram na chave do cache
+VARIANTE_RENDER = f"pdf_dpi={RASTER_DPI}|img_dpi={normalizacao_imagens.DPI_IMAGENS}|q={normalizacao_imagens.QUALIDADE_JPEG}"
+# No PDF final, as páginas dos PDFs de evidência entram em vetor (ver pdf_vetorial)
+PDF_VETORIAL = os.environ.get("PDF_VETORIAL", "1") != "0"
+
+FORM_KEYS = [
+    "sel_mes", "sel_ano", "in_total", "in_rx", "in_mc", "in_mp",
+    "in_oc", "in_op", "in_ccih", "in_oi", "in_oe", "in_taxa",
+    "in_tt", "in_to", "in_to_menor", "in_to_maior"
+]
+
+
+# --- METAS E CONTEXTO ---
+def calcular_metas(mes, ano):
+    """Meta do mês (dias * meta diária) e os limites de -25% e +25%."""
+    mes_num = MESES_PT.index(mes) + 1
+    dias_no_mes = calendar.monthrange(ano, mes_num)[1]
+    meta_calculada = dias_no_mes * META_DIARIA_CONTRATO
+    return meta_calculada, int(meta_calculada * 0.75), int(meta_calculada * 1.25)
+
+
+def montar_contexto(form_state):
+    """Campos de texto do template a partir do estado do formulário."""
+    fs = form_state
+    meta_calculada, meta_min, meta_max = calcular_metas(fs.get("sel_mes") or "janeiro", int(fs.get("sel_ano") or 2027))
+    # PROTEÇÃO CONTRA VAZIOS: Garantir que chaves inexistentes ou vazias não quebrem a lógica
+    return {
+        "SISTEMA_MES_REFERENCIA": f"{fs.get('sel_mes', 'Janeiro')}/{fs.get('sel_ano', 2026)}",
+        "ANALISTA_TOTAL_ATENDIMENTOS": fs.get("in_total", ""),
+        "TOTAL_RAIO_X": fs.get("in_rx", ""),
+        "ANALISTA_META_MES": str(meta_calculada),
+        "ANALISTA_META_MINUS_25": str(meta_min),
+        "ANALISTA_META_PLUS_25": str(meta_max),
+        "ANALISTA_MEDICO_CLINICO": fs.get("in_mc", ""),
+        "ANALISTA_MEDICO_PEDIATRA": fs.get("in_mp", ""),
+        "ANALISTA_ODONTO_CLINICO": fs.get("in_oc", ""),
+        "ANALISTA_ODONTO_PED": fs.get("in_op", ""),
+        "TOTAL_PACIENTES_CCIH": fs.get("in_ccih", ""),
+        "OUVIDORIA_INTERNA": fs.get("in_oi", ""),
+        "OUVIDORIA_EXTERNA": fs.get("in_oe", ""),
+        "SISTEMA_TOTAL_DE_TRANSFERENCIA": fs.get("in_tt", 0),
+        "SISTEMA_TAXA_DE_TRANSFERENCIA": fs.get("in_taxa", ""),
+        "ANALISTA_TOTAL_OBITO": fs.get("in_to", 0),
+        "ANALISTA_OBITO_MENOR": fs.get("in_to_menor", 0),
+        "ANALISTA_OBITO_MAIOR": fs.get("in_to_maior", 0),
+        "SISTEMA_TOTAL_MEDICOS": int(fs.get("in_mc", 0) or 0) + int(fs.get("in_mp", 0) or 0)
+    }
+
+
+# Callback de progresso da geração em curso neste contexto, para a rasterização
+# e a conversão também o chamarem (são os pontos em que se pode cancelar)
+_progresso_atual = contextvars.ContextVar("progresso_geracao", default=None)
+
+
+# --- FUNÇÕES CORE ---
+def converter_para_pdf(docx_path, output_dir):
+    """Cliente do serviço de conversão (perfil do LibreOffice já criado, fila e timeout)."""
+    progresso = _progresso_atual.get()
+    verificar = (lambda: progresso("converter")) if progresso else None
+    with diagnostico.span("converter", bytes_entrada=os.path.getsize(docx_path)) as sp:
+        pdf_path = conversor_pdf.converter(docx_path, output_dir, verificar=verificar)
+        sp["bytes"] = os.path.getsize(pdf_path)
+    return pdf_path
+
+
+def hash_item(item):
+    """Hash do conteúdo de uma evidência (PIL, bytes ou ficheiro)."""
+    if isinstance(item, Image.Image):
+        return cache_render.hash_bytes(f"{item.mode}|{item.size}".encode() + item.tobytes())
+    if isinstance(item, bytes):
+        return cache_render.hash_bytes(item)
+    if hasattr(item, "getvalue"):
+        return cache_render.hash_bytes(item.getvalue())
+    item.seek(0)
+    data = item.read()
+    item.seek(0)
+    return cache_render.hash_bytes(data)
+
+
+def dados_conteudo(conteudo):
+    """Bytes de uma evidência em memória (PIL, UploadedFile, BytesIO ou bytes)."""
+    if isinstance(conteudo, Image.Image):
+        return normalizacao_imagens.png_canonico(conteudo)
+    if hasattr(conteudo, "getvalue"): return conteudo.getvalue()
+    if hasattr(conteudo, "read"):
+        conteudo.seek(0)
+        return conteudo.read()
+    return conteudo
+
+
+def _renderizar_dados(data, ext, largura):
+    if ext.endswith(".pdf"):
+        return list(rasterizacao_pdf.rasterizar_pdf(data, largura, RASTER_DPI, _progresso_atual.get()))
+    if ext.endswith((".xlsx", ".xls")):
+        return tabela_excel.renderizar_planilha(data, ext, largura, normalizacao_imagens.DPI_IMAGENS)
+    return [normalizacao_imagens.normalizar_imagem(data, largura)]
+
+
+def _renderizar_item(item, ext, largura):
+    """Converte uma evidência nas imagens normalizadas que vão para o relatório.
+
+    Devolve ``(imagens, meta)``, com os bytes originais em ``meta`` para o
+    relatório de poupança por marcador.
+    """
+    if "content" in item:
+        data = dados_conteudo(item["content"])
+        return _renderizar_dados(data, ext, largura), {"bytes_originais": len(data)}
+
+    sha = item["sha256"]
+    if ext.endswith(".pdf"):
+        # O pool de rasterização abre o ficheiro do armazém diretamente, sem cópias
+        caminho = armazem_evidencias.ARMAZEM.caminho(sha)
+        paginas = rasterizacao_pdf.rasterizar_pdf(caminho, largura, RASTER_DPI, _progresso_atual.get())
+        return list(paginas), {"bytes_originais": caminho.stat().st_size}
+    with armazem_evidencias.ARMAZEM.abrir(sha) as mm:
+        return _renderizar_dados(mm, ext, largura), {"bytes_originais": len(mm)}
+
+
+def processar_item_lista(doc_template, item, marcador, estatisticas=None):
+    """Imagens (``InlineImage``) de uma evidência para o marcador.
+
+    ``item`` é uma evidência com ``"content"`` em memória ou um handle do
+    armazém de evidências (``"sha256"``); no segundo caso os bytes só são
+    lidos se o resultado não estiver no cache de renderização.
+    """
+    largura = DIMENSOES_CAMPOS.get(marcador, 165)
+    try:
+        with diagnostico.span("item", marcador=marcador, evidencia=item["name"]) as sp:
+            conteudo = item.get("content")
+            ext = ".png" if isinstance(conteudo, Image.Image) else item["name"].lower()
+            sha = item.get("sha256") or hash_item(conteudo)
+            sp["cache"] = "hit"
+
+            def renderizar():
+                sp["cache"] = "miss"
+                return _renderizar_item(item, ext, largura)
+
+            # Rasterização/normalização/plotagem custam CPU; o resultado é reaproveitado entre gerações
+            chave = cache_render.chave_render(sha, marcador, largura, VARIANTE_RENDER)
+            imgs, meta = cache_render.CACHE.obter_ou_renderizar(chave, renderizar)
+            sp["bytes_entrada"] = meta.get("bytes_originais", 0)
+            sp["bytes"] = sum(len(b) for b in imgs)
+            sp["imagens"] = len(imgs)
+            if estatisticas is not None:
+                antes, depois = estatisticas.get(marcador, (0, 0))
+                estatisticas[marcador] = (antes + sp["bytes_entrada"], depois + sp["bytes"])
+            return [InlineImage(doc_template, io.BytesIO(b), width=Mm(largura)) for b in imgs]
+    except Exception:
+        return []
+
+
+def _contexto_vetorial(doc, evidencias, registo, estatisticas=None):
+    """Imagens por marcador com marcadores de posição no lugar das páginas dos PDFs de evidência."""
+    dados = {}
+    for marcador, largura in DIMENSOES_CAMPOS.items():
+        lista_imgs = []
+        for item in evidencias.get(marcador, []):
+            if not item["name"].lower().endswith(".pdf"):
+                lista_imgs.extend(processar_item_lista(doc, item, marcador, estatisticas))
+                continue
+            if "content" in item:
+                origem = dados_conteudo(item["content"])
+            else:
+                origem = armazem_evidencias.ARMAZEM.caminho(item["sha256"])
+            try:
+                pngs = registo.marcadores_pdf(origem)
+            except Exception:
+                pngs = []
+            lista_imgs.extend(InlineImage(doc, io.BytesIO(b), width=Mm(largura)) for b in pngs)
+        dados[marcador] = lista_imgs
+    return dados
+
+
+def _converter_vetorial(form_state, evidencias, template, pasta_saida, nome_base, estatisticas=None):
+    """PDF com o corpo do DOCX convertido pelo LibreOffice e as páginas dos PDFs de evidência em vetor."""
+    pasta_tmp = tempfile.mkdtemp(prefix=".vetorial_", dir=pasta_saida)
+    try:
+        doc = cache_template.CACHE.obter(template)
+        registo = pdf_vetorial.RegistoMarcadores()
+        dados = montar_contexto(form_state)
+        dados.update(_contexto_vetorial(doc, evidencias, registo, estatisticas))
+        with diagnostico.span("render_vetorial"):
+            doc.render(dados)
+        docx_corpo = os.path.join(pasta_tmp, f"{nome_base}.docx")
+        doc.save(docx_corpo)
+        pdf_p = converter_para_pdf(docx_corpo, pasta_saida)
+        try:
+            with diagnostico.span("inserir_paginas", paginas=len(registo.paginas)) as sp:
+                pdf_vetorial.substituir_marcadores(pdf_p, registo)
+                sp["bytes"] = os.path.getsize(pdf_p)
+        except Exception:
+            os.remove(pdf_p)
+            raise
+        return pdf_p
+    finally:
+        shutil.rmtree(pasta_tmp, ignore_errors=True)
+
+
+def gerar_relatorio(form_state, evidencias, pasta_saida, nome_base="relatorio", pdf=True,
+                    template=TEMPLATE_PADRAO, estatisticas=None, progresso=None, vetorial=PDF_VETORIAL,
+                    docx=True):
+    """Gera ``<nome_base>.docx`` (e ``.pdf`` se ``pdf``) em ``pasta_saida``.
+
+    ``evidencias`` é ``{marcador: [evidência, ...]}``, com evidências em
+    memória (``{"name", "content", "type"}``) ou handles do armazém de
+    evidências, como em ``st.session_state.dados_sessao``. Devolve
+    ``{"docx": caminho, "pdf": caminho ou None}``; uma falha na conversão para
+    PDF não impede o DOCX e fica em ``"erro_pdf"``.
+
+    Com ``vetorial``, o PDF leva as páginas dos PDFs de evidência em vetor
+    em vez das imagens rasterizadas do DOCX (``"modo_pdf"`` indica o modo
+    usado); se a inserção falhar, o PDF é convertido a partir do DOCX.
+
+    Com ``docx=False`` (e ``pdf``) só o PDF é pedido: ``"docx"`` vem ``None``
+    se o PDF for gerado e, no modo vetorial, o DOCX com as páginas
+    rasterizadas só é gerado (como intermediário) se o PDF vetorial não for
+    possível.
+
+    ``progresso(etapa, feitos, total)``, se dado, é chamado antes de cada
+    evidência (etapa ``"marcadores"``) e de ``"render"``, ``"save"`` e
+    ``"converter"``, e ainda antes de cada página rasterizada (``"pagina"``)
+    e periodicamente durante a conversão (``"converter"``); uma exceção
+    lançada por ele interrompe a geração — para atravessar os ``except
+    Exception`` do caminho de geração, deve herdar de ``BaseException``.
+    """
+    if progresso is None:
+        progresso = lambda etapa, feitos=0, total=0: None
+        token = None
+    else:
+        token = _progresso_atual.set(progresso)
+    try:
+        return _gerar(form_state, evidencias, pasta_saida, nome_base, pdf, template, estatisticas, progresso,
+                      vetorial, docx or not pdf)
+    finally:
+        if token is not None:
+            _progresso_atual.reset(token)
+
+
+def _gerar(form_state, evidencias, pasta_saida, nome_base, pdf, template, estatisticas, progresso, vetorial, docx):
+    resultado = {"docx": None, "pdf": None}
+    vetorial = pdf and vetorial and any(i["name"].lower().endswith(".pdf") for itens in evidencias.values() for i in itens)
+    if vetorial and not docx:
+        # Só o PDF: o DOCX rasterizado não é preciso se o vetorial resultar
+        progresso("converter")
+        _pdf_vetorial(resultado, form_state, evidencias, template, pasta_saida, nome_base, estatisticas)
+        if resultado["pdf"] or "erro_pdf" in resultado:
+            return resultado
+
+    docx_p = os.path.join(pasta_saida, f"{nome_base}.docx")
+    doc = cache_template.CACHE.obter(template)
+
+    dados_finais = montar_contexto(form_state)
+    total = len(DIMENSOES_CAMPOS)
+    for feitos, marcador in enumerate(DIMENSOES_CAMPOS.keys()):
+        lista_imgs = []
+        itens = evidencias.get(marcador, [])
+        with diagnostico.span("marcador", marcador=marcador, itens=len(itens)) as sp:
+            for item in itens:
+                progresso("marcadores", feitos, total)
+                res = processar_item_lista(doc, item, marcador, estatisticas)
+                if res: lista_imgs.extend(res)
+            sp["imagens"] = len(lista_imgs)
+        dados_finais[marcador] = lista_imgs
+    progresso("marcadores", total, total)
+
+    progresso("render")
+    with diagnostico.span("render"):
+        doc.render(dados_finais)
+    progresso("save")
+    with diagnostico.span("save") as sp:
+        doc.save(docx_p)
+        sp["bytes"] = os.path.getsize(docx_p)
+
+    resultado["docx"] = docx_p
+    if pdf:
+        progresso("converter")
+        if vetorial and docx:
+            _pdf_vetorial(resultado, form_state, evidencias, template, pasta_saida, nome_base)
+        if resultado["pdf"] is None and "erro_pdf" not in resultado:
+            try:
+                resultado["pdf"], resultado["modo_pdf"] = converter_para_pdf(docx_p, pasta_saida), "raster"
+            except Exception as e:
+                resultado["erro_pdf"] = str(e)
+    if not docx and resultado["pdf"]:
+        os.remove(docx_p)
+        resultado["docx"] = None
+    return resultado
+
+
+def _pdf_vetorial(resultado, form_state, evidencias, template, pasta_saida, nome_base, estatisticas=None):
+    """Tenta o PDF vetorial; o resultado (ou o erro/aviso) fica em ``resultado``."""
+    try:
+        resultado["pdf"] = _converter_vetorial(form_state, evidencias, template, pasta_saida, nome_base, estatisticas)
+        resultado["modo_pdf"] = "vetorial"
+    except conversor_pdf.ErroConversao as e:
+        # O LibreOffice falhou: converter o DOCX rasterizado falharia também
+        resultado["erro_pdf"] = str(e)
+    except Exception as e:
+        resultado["aviso_pdf"] = f"PDF vetorial indisponível ({e}); usadas as páginas rasterizadas."
+
+
+# --- BACKUPS E ARMAZÉM DE EVIDÊNCIAS ---
+# Formatos que já vêm comprimidos: guardados no ZIP sem DEFLATE
+EXTENSOES_JA_COMPRIMIDAS = (".png", ".jpg", ".jpeg", ".pdf", ".xlsx", ".zip")
+
+
+def escrever_backup_zip(form_state, evidencias, destino):
+    """Escreve em ``destino`` (caminho ou ficheiro aberto) o ZIP de backup.
+
+    ``evidencias`` são handles do armazém de evidências; cada conteúdo é
+    guardado uma vez, pelo hash, por isso duplicados ocupam um único membro.
+    """
+    with zipfile.ZipFile(destino, "w", zipfile.ZIP_DEFLATED) as zf:
+        evid_meta = {}
+        escritos = set()
+        for marcador, itens in evidencias.items():
+            evid_meta[marcador] = []
+            for item in itens:
+                sha = item["sha256"]
+                ext = Path(item["name"]).suffix.lower() or ".bin"
+
+                # Guardar ficheiro dentro do ZIP (uma vez por conteúdo)
+                nome_interno = f"evidencias/{sha[:24]}{ext}"
+                if nome_interno not in escritos:
+                    compressao = zipfile.ZIP_STORED if ext in EXTENSOES_JA_COMPRIMIDAS else zipfile.ZIP_DEFLATED
+                    with armazem_evidencias.ARMAZEM.abrir(sha) as mm:
+                        zf.writestr(nome_interno, mm, compress_type=compressao)
+                    escritos.add(nome_interno)
+
+                # Registar metadados
+                evid_meta[marcador].append({"name": item["name"], "file": nome_interno, "type": item["type"], "sha256": sha})
+
+        # Guardar o estado do formulário no ZIP
+        estado = {"form_state": form_state, "evidencias": evid_meta}
+        zf.writestr("estado.json", json.dumps(estado, ensure_ascii=False, indent=2))
+
+
+def guardar_no_armazem(evidencias):
+    """Passa as evidências lidas de uma pasta/backup para o armazém e devolve os handles."""
+    handles = {}
+    for m, itens in evidencias.items():
+        handles[m] = []
+        for item in itens:
+            handle = armazem_evidencias.ARMAZEM.adicionar(dados_conteudo(item["content"]), item["name"], item["type"], item.get("sha256"))
+            if "blob" in item:
+                handle["blob"] = item["blob"]
+            handles[m].append(handle)
+    return handles
+
+
+# --- LEITURA DE RELATÓRIOS SALVOS E BACKUPS ---
+def _evidencia(nome, data, tipo, sha=None):
+    bio = io.BytesIO(data)
+    bio.name = nome
+    item = {"name": nome, "content": bio, "type": tipo}
+    if sha:
+        # Já está no armazém de blobs: salvar de novo não precisa de reescrever
+        item["sha256"] = item["blob"] = sha
+    return item
+
+
+def ler_relatorio_pasta(pasta):
+    """Lê ``estado.json`` e as evidências de uma pasta salva. Devolve ``(form_state, evidencias)``."""
+    pasta = Path(pasta)
+    armazem = armazenamento.ArmazemBlobs(pasta.parent)
+    with open(pasta / "estado.json", "r", encoding="utf-8") as f:
+        estado = json.load(f)
+    evidencias = {m: [] for m in DIMENSOES_CAMPOS.keys()}
+    for m, lista in estado.get("evidencias", {}).items():
+        for meta in lista:
+            if "sha256" in meta:
+                p, sha = armazem.caminho(meta["sha256"]), meta["sha256"]
+            else:
+                p, sha = pasta / meta["file"], None
+            if p.exists():
+                evidencias.setdefault(m, []).append(_evidencia(meta["name"], p.read_bytes(), meta["type"], sha))
+    return estado.get("form_state", {}), evidencias
+
+
+def abrir_relatorio_pasta(pasta):
+    """Como ``ler_relatorio_pasta``, mas sem ler as evidências: devolve handles do armazém de evidências.
+
+    Os blobs são ligados ao armazém de evidências (``importar``), sem ler os
+    bytes, e os handles da sessão não dependem de o blob continuar a existir.
+    Manifestos antigos (``"file"``) são lidos e copiados como antes.
+    """
+    pasta = Path(pasta)
+    blobs = armazenamento.ArmazemBlobs(pasta.parent)
+    with open(pasta / "estado.json", "r", encoding="utf-8") as f:
+        estado = json.load(f)
+    if any("sha256" not in meta for lista in estado.get("evidencias", {}).values() for meta in lista):
+        form_state, evidencias = ler_relatorio_pasta(pasta)
+        return form_state, guardar_no_armazem(evidencias)
+    evidencias = {m: [] for m in DIMENSOES_CAMPOS.keys()}
+    for m, lista in estado.get("evidencias", {}).items():
+        for meta in lista:
+            sha = meta["sha256"]
+            try:
+                handle = armazem_evidencias.ARMAZEM.importar(blobs.caminho(sha), meta["name"], meta["type"], sha)
+            except FileNotFoundError:
+                continue  # blob em falta (ou recolhido entretanto)
+            evidencias.setdefault(m, []).append({**handle, "blob": sha})
+    return estado.get("form_state", {}), evidencias
+
+
+def ler_origem(origem):
+    """Aceita uma pasta salva (com ``estado.json``) ou um backup ``.zip``.
+
+    Devolve ``(form_state, evidencias, falhas)``. Os backups passam pelo
+    mesmo restauro validado da interface (``restauro_backup``): ``falhas``
+    lista os itens que não foram restaurados e um ZIP inválido levanta
+    ``BackupInvalido``.
+    """
+    origem = Path(origem)
+    if origem.is_dir():
+        return (*ler_relatorio_pasta(origem), [])
+    import restauro_backup  # importa este módulo
+    return restauro_backup.restaurar(origem)
@@ -0,0 +1,110 @@
+"""Normalização das imagens antes de entrarem no DOCX.
+
+Cada imagem é reduzida aos píxeis que a largura do marcador realmente usa no
+DPI configurado, recodificada em PNG (prints/ecrãs, poucas cores) ou JPEG
+(fotografias) e gravada sem metadados (EXIF, ICC, texto PNG).
+"""
+import io
+import os
+
+from PIL import Image, ImageOps
+
+DPI_IMAGENS = int(os.environ.get("IMAGENS_DPI", 200))
+QUALIDADE_JPEG = int(os.environ.get("IMAGENS_QUALIDADE_JPEG", 85))
+# Acima deste número de cores distintas (numa amostra) a imagem é tratada como foto.
+LIMITE_CORES_PRINT = 2048
+
+
+def largura_px(largura_mm, dpi=DPI_IMAGENS):
+    return max(1, round(largura_mm / 25.4 * dpi))
+
+
+def _tem_transparencia(img):
+    if img.mode in ("RGBA", "LA"):
+        return img.getchannel("A").getextrema()[0] < 255
+    return img.mode == "P" and "transparency" in img.info
+
+
+def parece_foto(img):
+    """Heurística: prints têm poucas cores distintas, fotografias têm milhares."""
+    amostra = img.convert("RGB")
+    amostra.thumbnail((256, 256))
+    return amostra.getcolors(maxcolors=LIMITE_CORES_PRINT) is None
+
+
+def codificar_jpeg(img, qualidade=QUALIDADE_JPEG):
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=qualidade, progressive=True)
+    return buf.getvalue()
+
+
+def _png(img):
+    buf = io.BytesIO()
+    # Sem optimize=True: custa ~9x o tempo de codificação para ganhar ~3% de tamanho
+    img.save(buf, format="PNG", compress_level=6)
+    return buf.getvalue()
+
+
+def codificar(img, qualidade=QUALIDADE_JPEG):
+    """Codifica ``img`` em PNG ou JPEG conforme o conteúdo, sem metadados."""
+    transparente = _tem_transparencia(img)
+    if parece_foto(img) and not transparente:
+        return codificar_jpeg(img, qualidade)
+    if img.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+        img = img.convert("RGBA" if transparente else "RGB")
+    data = _png(img)
+    if img.mode == "RGB" and img.getcolors(maxcolors=256) is not None:
+        # Prints com até 256 cores: o median cut gera a paleta exata, sem perda;
+        # só fica se for de facto menor
+        paleta = _png(img.quantize(colors=256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE))
+        if len(paleta) < len(data):
+            data = paleta
+    return data
+
+
+def png_canonico(img):
+    """PNG determinístico de uma imagem em memória (ex.: print colado).
+
+    É a codificação única feita na entrada: sem metadados e sem o canal alfa
+    quando a imagem é opaca, para que o mesmo print dê sempre os mesmos bytes
+    (e o mesmo sha256).
+    """
+    img.load()
+    transparente = _tem_transparencia(img)
+    if img.mode in ("RGBA", "LA") and not transparente:
+        img = img.convert("RGB" if img.mode == "RGBA" else "L")
+    elif img.mode not in ("RGB", "RGBA", "L", "LA", "P", "1"):
+        img = img.convert("RGBA" if transparente else "RGB")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", compress_level=6)
+    return buf.getvalue()
+
+
+def normalizar_imagem(origem, largura_mm, dpi=DPI_IMAGENS, qualidade=QUALIDADE_JPEG):
+    """Devolve os bytes normalizados de ``origem`` (bytes, ``mmap`` ou ``PIL.Image``).
+
+    Se o original não tem metadados e o resultado não for menor, os bytes
+    originais são mantidos (o Word escala a imagem para a largura do campo).
+    """
+    original = None if isinstance(origem, Image.Image) else origem
+    if original is None:
+        img = origem
+    elif hasattr(original, "read"):
+        original.seek(0)
+        img = Image.open(original)
+    else:
+        img = Image.open(io.BytesIO(original))
+    img.load()
+    tem_metadados = any(k in img.info for k in ("exif", "icc_profile", "xmp"))
+    # Aplica a rotação do EXIF antes de o descartar
+    img = ImageOps.exif_transpose(img)
+
+    alvo = largura_px(largura_mm, dpi)
+    if img.width > alvo:
+        altura = max(1, round(img.height * alvo / img.width))
+        img = img.resize((alvo, altura), Image.LANCZOS)
+
+    data = codificar(img, qualidade)
+    if original is not None and not tem_metadados and len(data) >= len(original):
+        return bytes(original)
+    return data
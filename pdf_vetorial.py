@@ -0,0 +1,86 @@
+"""Inserção das páginas originais dos PDFs de evidência no PDF final, em vetor.
+
+Em vez de rasterizar cada página de um PDF de evidência, o DOCX enviado ao
+LibreOffice leva um marcador de posição por página: um PNG branco com a
+proporção da página e uma largura em píxeis única no documento. Depois da
+conversão, cada marcador é localizado no PDF pelas suas dimensões
+(``get_image_info``), tapado de branco e substituído pela página original com
+``show_pdf_page`` — texto e vetores intactos, à largura do marcador.
+
+Se algum marcador não for encontrado (ex.: o LibreOffice reamostrou as
+imagens), ``substituir_marcadores`` levanta ``MarcadoresEmFalta`` e quem
+chamou pode voltar à conversão rasterizada.
+"""
+import io
+import os
+import tempfile
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+import rasterizacao_pdf
+
+# Largura (px) do primeiro marcador; os seguintes vão somando 1
+LARGURA_BASE_PX = 600
+
+
+class MarcadoresEmFalta(RuntimeError):
+    pass
+
+
+class RegistoMarcadores:
+    """Marcadores de posição de um documento: largura em píxeis -> página de origem."""
+
+    def __init__(self):
+        self.paginas = {}
+
+    def marcadores_pdf(self, origem):
+        """Um PNG de marcador por página do PDF ``origem`` (caminho ou bytes)."""
+        pngs = []
+        with rasterizacao_pdf.FITZ_LOCK, rasterizacao_pdf.abrir_pdf(origem) as pdf:
+            for i, pagina in enumerate(pdf):
+                largura = LARGURA_BASE_PX + len(self.paginas)
+                altura = max(1, round(largura * pagina.rect.height / pagina.rect.width))
+                self.paginas[(largura, altura)] = (origem, i)
+                buf = io.BytesIO()
+                Image.new("1", (largura, altura), 1).save(buf, format="PNG", optimize=True)
+                pngs.append(buf.getvalue())
+        return pngs
+
+
+def substituir_marcadores(caminho_pdf, registo):
+    """Troca, em ``caminho_pdf``, cada marcador pela página original correspondente."""
+    if not registo.paginas:
+        return
+    with rasterizacao_pdf.FITZ_LOCK:
+        _substituir(caminho_pdf, registo)
+
+
+def _substituir(caminho_pdf, registo):
+    fontes = {}
+    encontrados = set()
+    try:
+        with fitz.open(caminho_pdf) as saida:
+            for pagina in saida:
+                for info in pagina.get_image_info():
+                    chave = (info["width"], info["height"])
+                    if chave not in registo.paginas or chave in encontrados:
+                        continue
+                    origem, indice = registo.paginas[chave]
+                    id_origem = str(origem) if isinstance(origem, (str, os.PathLike)) else id(origem)
+                    if id_origem not in fontes:
+                        fontes[id_origem] = rasterizacao_pdf.abrir_pdf(origem)
+                    caixa = fitz.Rect(info["bbox"])
+                    pagina.draw_rect(caixa, color=None, fill=(1, 1, 1), overlay=True)
+                    pagina.show_pdf_page(caixa, fontes[id_origem], indice, keep_proportion=True)
+                    encontrados.add(chave)
+            em_falta = len(registo.paginas) - len(encontrados)
+            if em_falta:
+                raise MarcadoresEmFalta(f"{em_falta} páginas de evidência não foram localizadas no PDF convertido")
+            fd, tmp = tempfile.mkstemp(suffix=".pdf", dir=os.path.dirname(os.path.abspath(caminho_pdf)))
+            os.close(fd)
+            saida.save(tmp, garbage=3, deflate=True)
+    finally:
+        for f in fontes.values():
+            f.close()
+    os.replace(tmp, caminho_pdf)
@@ -0,0 +1,189 @@
+"""Rasterização paralela das páginas de PDFs de evidência.
+
+As páginas são repartidas em blocos por um pool de processos e devolvidas em
+ordem, à medida que ficam prontas, por um gerador. O zoom de cada página é
+calculado a partir da largura do marcador (mm) e de um DPI alvo, em vez do
+antigo ``fitz.Matrix(2, 2)`` fixo.
+
+O PyMuPDF não suporta ser usado por várias threads ao mesmo tempo (pode
+derrubar o interpretador). Cada processo do pool só tem uma thread; no
+processo principal, onde as gerações, as miniaturas e os restauros correm em
+threads, todo o uso do ``fitz`` passa por ``FITZ_LOCK``.
+"""
+import atexit
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+import diagnostico
+import normalizacao_imagens
+
+DPI_PADRAO = int(os.environ.get("RASTER_DPI", 200))
+PAGINAS_POR_TAREFA = 4
+# Abaixo disto não compensa o custo de enviar o trabalho para outro processo.
+MIN_PAGINAS_PARALELO = 6
+MAX_PROCESSOS = max(1, min(4, (os.cpu_count() or 1)))
+
+_pool = None
+_pool_lock = threading.Lock()
+# Serializa o uso do PyMuPDF entre as threads deste processo (ver acima)
+FITZ_LOCK = threading.RLock()
+
+
+def calcular_zoom(largura_pagina_pt, largura_mm, dpi=DPI_PADRAO):
+    """Zoom para que a página tenha os píxeis necessários a ``largura_mm`` em ``dpi``."""
+    largura_px = largura_mm / 25.4 * dpi
+    return max(largura_px / max(largura_pagina_pt, 1), 0.25)
+
+
+def _rasterizar_pagina(pagina, largura_mm, dpi):
+    zoom = calcular_zoom(pagina.rect.width, largura_mm, dpi)
+    pix = pagina.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    # O PNG do PyMuPDF é o mais rápido e, em páginas de texto, menor do que recodificar
+    png = pix.tobytes("png")
+    img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    if normalizacao_imagens.parece_foto(img):
+        # Digitalizações/fotos: JPEG, se for mesmo menor
+        jpeg = normalizacao_imagens.codificar_jpeg(img)
+        if len(jpeg) < len(png):
+            return jpeg
+    return png
+
+
+def _rasterizar_medida(pagina, largura_mm, dpi):
+    inicio = time.perf_counter()
+    img = _rasterizar_pagina(pagina, largura_mm, dpi)
+    return img, time.perf_counter() - inicio
+
+
+def _rasterizar_intervalo(caminho, inicio, fim, largura_mm, dpi):
+    """Executado nos processos do pool: rasteriza as páginas [inicio, fim).
+
+    Devolve ``(imagem, segundos)`` por página, para o diagnóstico do processo principal.
+    """
+    with fitz.open(caminho) as pdf:
+        return [_rasterizar_medida(pdf[i], largura_mm, dpi) for i in range(inicio, fim)]
+
+
+def _pagina_local(pdf, i, largura_mm, dpi):
+    with diagnostico.span("pagina", pagina=i + 1, processo="local") as sp:
+        with FITZ_LOCK:
+            img = _rasterizar_pagina(pdf[i], largura_mm, dpi)
+        sp["bytes"] = len(img)
+    return img
+
+
+def _paginas_locais(origem, inicio, largura_mm, dpi, progresso):
+    """Rasteriza neste processo as páginas de ``inicio`` em diante, uma de cada vez sob ``FITZ_LOCK``."""
+    with FITZ_LOCK:
+        pdf = abrir_pdf(origem)
+    try:
+        total = pdf.page_count
+        for i in range(inicio, total):
+            progresso("pagina", i, total)
+            yield _pagina_local(pdf, i, largura_mm, dpi)
+    finally:
+        with FITZ_LOCK:
+            pdf.close()
+
+
+def _obter_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # "spawn" evita herdar as threads do servidor Streamlit num fork
+            ctx = multiprocessing.get_context("spawn")
+            _pool = ProcessPoolExecutor(max_workers=MAX_PROCESSOS, mp_context=ctx)
+        return _pool
+
+
+def _descartar_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+atexit.register(_descartar_pool)
+
+
+def abrir_pdf(origem):
+    """Abre ``origem`` (caminho ou bytes); no processo principal, chamar com ``FITZ_LOCK``."""
+    if isinstance(origem, (str, os.PathLike)):
+        return fitz.open(origem)
+    return fitz.open(stream=origem, filetype="pdf")
+
+
+def contar_paginas(origem):
+    with FITZ_LOCK, abrir_pdf(origem) as pdf:
+        return pdf.page_count
+
+
+def rasterizar_pdf(origem, largura_mm, dpi=DPI_PADRAO, progresso=None):
+    """Gera as imagens (PNG/JPEG) das páginas de ``origem``, por ordem.
+
+    ``origem`` é o caminho de um PDF ou os seus bytes; neste caso, os PDFs
+    grandes são copiados para um temporário que os processos possam abrir.
+
+    PDFs pequenos são renderizados no próprio processo; os maiores são
+    divididos em blocos de ``PAGINAS_POR_TAREFA`` páginas e enviados ao pool,
+    com no máximo ``2 * MAX_PROCESSOS`` blocos em voo para limitar a memória.
+
+    ``progresso("pagina", feitas, total)``, se dado, é chamado antes de cada
+    página; se levantar uma exceção, os blocos ainda na fila são cancelados.
+    """
+    progresso = progresso or (lambda etapa, feitos=0, total=0: None)
+    total = contar_paginas(origem)
+    if total < MIN_PAGINAS_PARALELO or MAX_PROCESSOS == 1:
+        yield from _paginas_locais(origem, 0, largura_mm, dpi, progresso)
+        return
+
+    temporario = not isinstance(origem, (str, os.PathLike))
+    if temporario:
+        fd, caminho = tempfile.mkstemp(suffix=".pdf")
+        with os.fdopen(fd, "wb") as f:
+            f.write(origem)
+    else:
+        caminho = str(origem)
+    pendentes = deque()
+    gerados = 0
+    try:
+        try:
+            pool = _obter_pool()
+            for inicio in range(0, total, PAGINAS_POR_TAREFA):
+                progresso("pagina", gerados, total)
+                fim = min(inicio + PAGINAS_POR_TAREFA, total)
+                pendentes.append(pool.submit(_rasterizar_intervalo, caminho, inicio, fim, largura_mm, dpi))
+                if len(pendentes) >= 2 * MAX_PROCESSOS:
+                    for png, segundos in pendentes.popleft().result():
+                        diagnostico.registar("pagina", segundos, pagina=gerados + 1, processo="pool", bytes=len(png))
+                        yield png
+                        gerados += 1
+            while pendentes:
+                progresso("pagina", gerados, total)
+                for png, segundos in pendentes.popleft().result():
+                    diagnostico.registar("pagina", segundos, pagina=gerados + 1, processo="pool", bytes=len(png))
+                    yield png
+                    gerados += 1
+        except BrokenProcessPool:
+            # Um processo do pool morreu (ex.: falta de memória): o pool é
+            # recriado na próxima chamada e o resto deste PDF sai daqui mesmo.
+            _descartar_pool()
+            yield from _paginas_locais(caminho, gerados, largura_mm, dpi, progresso)
+    finally:
+        for fut in pendentes:
+            fut.cancel()
+        if temporario:
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass
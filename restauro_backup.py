@@ -0,0 +1,159 @@
+"""Restauro validado de backups ZIP para o armazém de evidências.
+
+Antes de extrair seja o que for, o ZIP é inspecionado: número de membros,
+tamanho total e por membro e razão de compressão (contra zip bombs). Depois,
+cada evidência é descomprimida em streaming diretamente para o armazém (sem
+passar por ``BytesIO``), o sha256 é comparado com o do manifesto e o
+conteúdo é validado (imagem descodificável, PDF legível...). Os membros são
+processados em paralelo por threads — zlib, hashlib e os descodificadores
+libertam o GIL —, exceto a abertura dos PDFs, que o PyMuPDF só aceita de uma
+thread de cada vez (``rasterizacao_pdf.FITZ_LOCK``).
+
+Um membro com problemas não impede o resto: ``restaurar`` devolve a lista de
+falhas, com o marcador, o nome e o motivo de cada uma. Só um ``estado.json``
+em falta ou ilegível, ou um ZIP acima dos limites globais, fazem falhar o
+restauro inteiro (``BackupInvalido``). Evidências repetidas (mesmo sha256)
+ficam só na primeira ocorrência e as restantes são listadas nas falhas.
+"""
+import json
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz  # PyMuPDF
+from PIL import Image
+
+import armazem_evidencias
+import rasterizacao_pdf
+from motor_relatorio import DIMENSOES_CAMPOS
+
+MAX_TOTAL_BYTES = int(os.environ.get("BACKUP_MAX_TOTAL_MB", 2048)) * 1024 * 1024
+MAX_MEMBRO_BYTES = int(os.environ.get("BACKUP_MAX_MEMBRO_MB", 300)) * 1024 * 1024
+MAX_MEMBROS = int(os.environ.get("BACKUP_MAX_MEMBROS", 5000))
+MAX_ESTADO_BYTES = 10 * 1024 * 1024
+# Razão descomprimido/comprimido acima da qual um membro é tratado como zip bomb
+MAX_RAZAO_COMPRESSAO = 100
+# Membros pequenos podem ter razões altas legitimamente (ex.: imagens lisas)
+MIN_BYTES_RAZAO = 1024 * 1024
+MAX_THREADS = max(1, min(8, os.cpu_count() or 1))
+
+
+class BackupInvalido(ValueError):
+    pass
+
+
+def _verificar_conteudo(sha, nome, tipo):
+    """Levanta uma exceção se o conteúdo não for do formato esperado pelo nome."""
+    armazem = armazem_evidencias.ARMAZEM
+    nome = nome.lower()
+    if tipo == "p" or nome.endswith((".png", ".jpg", ".jpeg")):
+        with armazem.abrir(sha) as mm:
+            Image.open(mm).verify()
+    elif nome.endswith(".pdf"):
+        # O PyMuPDF não é seguro entre threads: os PDFs são validados um de cada vez
+        with rasterizacao_pdf.FITZ_LOCK, fitz.open(armazem.caminho(sha)) as pdf:
+            if pdf.page_count == 0:
+                raise ValueError("PDF sem páginas")
+    elif nome.endswith(".xlsx"):
+        if not zipfile.is_zipfile(armazem.caminho(sha)):
+            raise ValueError("planilha .xlsx corrompida")
+
+
+def _restaurar_membro(zf, info, sha_esperado, nome, tipo):
+    with zf.open(info) as f:
+        # O zipfile nunca devolve mais do que o tamanho declarado e verifica o CRC no fim
+        handle = armazem_evidencias.ARMAZEM.adicionar_stream(f, nome, tipo, limite=MAX_MEMBRO_BYTES)
+    if sha_esperado and handle["sha256"] != sha_esperado:
+        raise ValueError(f"hash não confere com o manifesto ({handle['sha256'][:12]} ≠ {sha_esperado[:12]})")
+    try:
+        _verificar_conteudo(handle["sha256"], nome, tipo)
+    except Exception as e:
+        raise ValueError(f"conteúdo corrompido ou de outro formato ({e})")
+    return handle
+
+
+def _ler_estado(zf):
+    try:
+        info = zf.getinfo("estado.json")
+    except KeyError:
+        raise BackupInvalido("o ZIP não contém estado.json")
+    if info.file_size > MAX_ESTADO_BYTES:
+        raise BackupInvalido("estado.json demasiado grande")
+    try:
+        return json.loads(zf.read(info).decode("utf-8"))
+    except (ValueError, zipfile.BadZipFile) as e:
+        raise BackupInvalido(f"estado.json ilegível: {e}")
+
+
+def _inspecionar(zf, referenciados):
+    """Valida os limites globais; devolve ``{ficheiro: motivo}`` dos membros recusados."""
+    membros = zf.infolist()
+    if len(membros) > MAX_MEMBROS:
+        raise BackupInvalido(f"o ZIP tem {len(membros)} membros (máximo {MAX_MEMBROS})")
+    recusados = {}
+    total = 0
+    for ficheiro in referenciados:
+        try:
+            info = zf.getinfo(ficheiro)
+        except KeyError:
+            recusados[ficheiro] = "ficheiro em falta no ZIP"
+            continue
+        if info.file_size > MAX_MEMBRO_BYTES:
+            recusados[ficheiro] = f"{info.file_size / 1024 / 1024:.0f} MB excede o limite por ficheiro"
+        elif info.file_size > MIN_BYTES_RAZAO and info.file_size > MAX_RAZAO_COMPRESSAO * max(info.compress_size, 1):
+            recusados[ficheiro] = f"razão de compressão suspeita ({info.file_size // max(info.compress_size, 1)}:1)"
+        else:
+            total += info.file_size
+    if total > MAX_TOTAL_BYTES:
+        raise BackupInvalido(f"o conteúdo descomprimido ({total / 1024 / 1024:.0f} MB) excede o limite do backup")
+    return recusados
+
+
+def restaurar(origem, max_threads=MAX_THREADS):
+    """Restaura o backup ``origem`` (caminho ou ficheiro aberto).
+
+    Devolve ``(form_state, evidencias, falhas)``: ``evidencias`` são handles do
+    armazém por marcador, pela ordem do manifesto; ``falhas`` é uma lista de
+    ``{"marcador", "nome", "motivo"}`` dos itens que não foram restaurados.
+    """
+    try:
+        zf = zipfile.ZipFile(origem, "r")
+    except zipfile.BadZipFile as e:
+        raise BackupInvalido(f"ficheiro ZIP inválido: {e}")
+    with zf:
+        estado = _ler_estado(zf)
+        entradas = [(m, meta) for m, lista in estado.get("evidencias", {}).items() for meta in lista]
+        # Cada membro é restaurado uma vez, mesmo que vários itens o referenciem
+        membros = {}
+        for _, meta in entradas:
+            membros.setdefault(meta.get("file"), meta)
+        membros.pop(None, None)
+        recusados = _inspecionar(zf, membros)
+
+        resultados = dict(recusados)
+        with ThreadPoolExecutor(max_workers=max_threads) as pool:
+            futuros = {
+                ficheiro: pool.submit(_restaurar_membro, zf, zf.getinfo(ficheiro), meta.get("sha256"),
+                                      meta.get("name", ficheiro), meta.get("type", "f"))
+                for ficheiro, meta in membros.items() if ficheiro not in recusados
+            }
+            for ficheiro, fut in futuros.items():
+                try:
+                    resultados[ficheiro] = fut.result()
+                except Exception as e:
+                    resultados[ficheiro] = str(e) or type(e).__name__
+
+    evidencias = {m: [] for m in DIMENSOES_CAMPOS.keys()}
+    falhas = []
+    for marcador, meta in entradas:
+        nome = meta.get("name", meta.get("file", "?"))
+        res = resultados.get(meta.get("file"), "entrada sem ficheiro no manifesto")
+        if isinstance(res, dict):
+            evidencias.setdefault(marcador, []).append({**res, "name": nome, "type": meta.get("type", "f")})
+        else:
+            falhas.append({"marcador": marcador, "nome": nome, "motivo": res})
+    evidencias, repetidos = armazem_evidencias.deduplicar(evidencias)
+    for marcador, item, marcador_original, original in repetidos:
+        falhas.append({"marcador": marcador, "nome": item["name"],
+                       "motivo": f"repetida de {original['name']} ({marcador_original})"})
+    return estado.get("form_state", {}), evidencias, falhas
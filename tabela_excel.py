@@ -0,0 +1,123 @@
+"""Renderização de planilhas (.xlsx/.xls) em imagens de tabela para o relatório.
+
+A planilha é lida em modo streaming (``openpyxl`` ``read_only``) e paginada
+à medida que as linhas chegam: cada página de ``LINHAS_POR_PAGINA`` linhas é
+desenhada como uma tabela matplotlib (backend Agg) na largura do marcador
+assim que fica completa, sem juntar a folha inteira em memória. O cabeçalho
+(primeira linha com dados) repete-se em todas as páginas; as linhas vazias do
+fim e as colunas vazias à direita (de cada página) ficam de fora.
+
+Planilhas ``.xls`` são lidas com pandas, que precisa do ``xlrd``.
+"""
+import datetime
+import io
+import os
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+
+import normalizacao_imagens
+
+LINHAS_POR_PAGINA = int(os.environ.get("EXCEL_LINHAS_POR_PAGINA", 30))
+# Altura de cada linha da tabela, em mm
+ALTURA_LINHA_MM = 6.0
+
+
+def _formatar(valor):
+    if valor is None:
+        return ""
+    if isinstance(valor, datetime.datetime):
+        return valor.strftime("%d/%m/%Y %H:%M") if (valor.hour or valor.minute) else valor.strftime("%d/%m/%Y")
+    if isinstance(valor, datetime.date):
+        return valor.strftime("%d/%m/%Y")
+    if isinstance(valor, float):
+        return f"{valor:.0f}" if valor.is_integer() else f"{valor:.2f}".replace(".", ",")
+    return str(valor).strip()
+
+
+def _linhas_xlsx(data):
+    from openpyxl import load_workbook
+    # O zipfile do openpyxl precisa de um ficheiro; um mmap não serve diretamente
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        for linha in wb.active.iter_rows(values_only=True):
+            yield [_formatar(v) for v in linha]
+    finally:
+        wb.close()
+
+
+def _linhas_xls(data):
+    import pandas as pd
+    df = pd.read_excel(io.BytesIO(bytes(data)), header=None, dtype=object)
+    for linha in df.itertuples(index=False):
+        yield [_formatar(None if pd.isna(v) else v) for v in linha]
+
+
+def _recortar(cabecalho, linhas):
+    """Corta as colunas vazias à direita e completa as linhas mais curtas."""
+    largura = 1 + max(max((i for i, v in enumerate(l) if v), default=-1) for l in [cabecalho, *linhas])
+    return ([*cabecalho[:largura], *[""] * (largura - len(cabecalho))],
+            [[*l[:largura], *[""] * (largura - len(l))] for l in linhas])
+
+
+def paginas_planilha(data, nome, linhas_por_pagina=LINHAS_POR_PAGINA):
+    """Gera ``(cabecalho, linhas)`` de cada página, à medida que a planilha é lida."""
+    leitor = _linhas_xls if nome.lower().endswith(".xls") else _linhas_xlsx
+    cabecalho = None
+    pagina = []
+    vazias = 0  # linhas vazias pendentes: só entram se vier mais alguma com dados
+    paginas = 0
+    for linha in leitor(data):
+        if not any(linha):
+            if cabecalho is not None:
+                vazias += 1
+            continue  # antes da tabela, ou talvez já no fim dela
+        if cabecalho is None:
+            cabecalho = linha
+            continue
+        for nova in [[]] * vazias + [linha]:
+            pagina.append(nova)
+            if len(pagina) == linhas_por_pagina:
+                yield _recortar(cabecalho, pagina)
+                paginas += 1
+                pagina = []
+        vazias = 0
+    if cabecalho is not None and (pagina or not paginas):
+        yield _recortar(cabecalho, pagina)
+
+
+def _desenhar_pagina(cabecalho, linhas, largura_mm, dpi):
+    largura_pol = largura_mm / 25.4
+    altura_pol = (len(linhas) + 1) * ALTURA_LINHA_MM / 25.4
+    fig = Figure(figsize=(largura_pol, altura_pol), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.axis("off")
+
+    # Largura das colunas proporcional ao texto mais longo de cada uma
+    tamanhos = [max(len(str(c)) for c in coluna) or 1 for coluna in zip(cabecalho, *linhas)]
+    total = sum(min(t, 40) for t in tamanhos)
+    larguras = [min(t, 40) / total for t in tamanhos]
+
+    tabela = ax.table(cellText=linhas or [[""] * len(cabecalho)], colLabels=cabecalho,
+                      colWidths=larguras, bbox=[0.002, 0.002, 0.996, 0.996], cellLoc="center")
+    tabela.auto_set_font_size(False)
+    tabela.set_fontsize(max(4.0, min(8.0, 160.0 / max(total, 1) * largura_mm / 90)))
+    for (lin, _), celula in tabela.get_celld().items():
+        celula.set_linewidth(0.3)
+        if lin == 0:
+            celula.set_facecolor("#28a745")
+            celula.get_text().set_color("white")
+            celula.get_text().set_fontweight("bold")
+        elif lin % 2 == 0:
+            celula.set_facecolor("#f0f2f5")
+
+    fig.canvas.draw()
+    img = Image.frombuffer("RGBA", fig.canvas.get_width_height(), fig.canvas.buffer_rgba()).convert("RGB")
+    return normalizacao_imagens.codificar(img)
+
+
+def renderizar_planilha(data, nome, largura_mm, dpi):
+    """Gera as imagens (uma por página) da tabela da planilha ``data``."""
+    return [_desenhar_pagina(cabecalho, linhas, largura_mm, dpi) for cabecalho, linhas in paginas_planilha(data, nome)]